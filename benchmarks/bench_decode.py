@@ -0,0 +1,53 @@
+"""Per-frame decode cost of ambilight measured/processed payloads.
+
+Compares the standard json module (plus flattening into compact frames), orjson when it is
+installed (what fast_decode uses then), and the scanner of decode.py (what fast_decode uses
+without orjson), for 2-, 3- and 4-sided tv's.
+
+    python benchmarks/bench_decode.py
+"""
+import importlib.util
+import json
+import os
+import random
+import timeit
+
+_PATH = os.path.join(os.path.dirname(__file__), '..', 'custom_components', 'philips_ambilight+yeelight', 'decode.py')
+_SPEC = importlib.util.spec_from_file_location('decode', _PATH)
+decode = importlib.util.module_from_spec(_SPEC)
+_SPEC.loader.exec_module(decode)
+
+TOPOLOGIES = {
+    '2 sides': (('left', 5), ('right', 5)),
+    '3 sides': (('left', 4), ('top', 9), ('right', 4)),
+    '4 sides': (('left', 6), ('top', 14), ('right', 6), ('bottom', 14)),
+}
+NUMBER = 2000
+
+
+def make_payload(topology) -> bytes:
+    layer1 = {
+        side: {str(i): {'r': random.randrange(256), 'g': random.randrange(256), 'b': random.randrange(256)} for i in range(count)}
+        for side, count in topology
+    }
+    return json.dumps({'layer1': layer1}).encode()
+
+
+def main():
+    decoders = {'json': lambda raw: decode.flatten_layer(json.loads(raw)['layer1'])}
+    if decode.orjson is not None:
+        decoders['orjson'] = lambda raw: decode.flatten_layer(decode.orjson.loads(raw)['layer1'])
+    decoders['scanner'] = decode.scan_frame
+    print('{:<10}{:>8}'.format('tv', 'bytes') + ''.join('{:>12}'.format(name) for name in decoders) + '   (us per frame)')
+    for name, topology in TOPOLOGIES.items():
+        raw = make_payload(topology)
+        expected = decoders['json'](raw)
+        timings = []
+        for decoder in decoders.values():
+            assert decoder(raw) == expected
+            timings.append(min(timeit.repeat(lambda: decoder(raw), number=NUMBER, repeat=5)) / NUMBER * 1e6)
+        print('{:<10}{:>8}'.format(name, len(raw)) + ''.join('{:>12.1f}'.format(timing) for timing in timings))
+
+
+if __name__ == '__main__':
+    main()
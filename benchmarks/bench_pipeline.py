@@ -0,0 +1,259 @@
+"""End-to-end benchmark of the follow loop against a simulated TV and simulated lights.
+
+Runs AmbiHue and the yeelight, RGB, CT and DDP switches against the stand-ins of fakes.py, which run in a
+separate process so they don't count towards the measured CPU time. Yeelights are real TCP
+endpoints (in music mode), RGB and CT lights are a light.turn_on service registered on a bare
+Home Assistant instance that answers after --light-latency seconds (or, with --direct-updates, light
+entities the integration turns on directly), and the DDP output streams to a
+local UDP receiver (for ddp, --lights is the number of pixels). Needs Home Assistant installed
+(pip install homeassistant), but no network, TV or bulbs.
+
+For every scenario it reports the achieved frame rate, the CPU time of the integration per frame,
+and the latency from the TV serving a frame to a light receiving its colour (matched by colour, so
+not for CT lights, which only get a brightness).
+
+    python benchmarks/bench_pipeline.py --kinds yeelight,rgb,ct,ddp --lights 1,10,50 --duration 5
+    python benchmarks/bench_pipeline.py --kinds rgb,ct --direct-updates   # compare with the service path
+    python benchmarks/bench_pipeline.py --min-fps 9 --max-cpu-ms 10   # exits with 1 on a regression (run in CI)
+
+The CI workflow (.github/workflows/benchmarks.yml) runs it against Home Assistant 2024.3.3.
+"""
+import argparse
+import asyncio
+import bisect
+import importlib
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'custom_components'))
+
+import fakes # noqa: E402
+
+from homeassistant.components.light import DOMAIN as LIGHT_DOMAIN # noqa: E402
+from homeassistant.components.light import ColorMode, LightEntity # noqa: E402
+from homeassistant.const import STATE_ON # noqa: E402
+from homeassistant.core import HomeAssistant # noqa: E402
+
+switch = importlib.import_module('philips_ambilight+yeelight.switch')
+yeelight_async = importlib.import_module('philips_ambilight+yeelight.yeelight_async')
+
+KINDS = ('yeelight', 'rgb', 'ct', 'ddp')
+
+
+async def async_create_hass(config_dir) -> HomeAssistant:
+    try:
+        hass = HomeAssistant(config_dir)
+    except TypeError: # older versions take no arguments
+        hass = HomeAssistant()
+        hass.config.config_dir = config_dir
+    return hass
+
+
+class FakeLights:
+    """light.turn_on service that records when each light received which colour.
+
+    With direct_updates it also stands in for the light component, so the dispatcher resolves the
+    lights to FakeLightEntity and turns them on without the service.
+    """
+
+    def __init__(self, hass: HomeAssistant, latency, direct_updates=False) -> None:
+        self._latency = latency
+        self.received: list[tuple] = [] # (monotonic time, (r, g, b) or None)
+        self.calls = 0
+        self._entities: dict[str, FakeLightEntity] = {}
+        hass.services.async_register('light', 'turn_on', self._async_turn_on)
+        if direct_updates:
+            hass.data[LIGHT_DOMAIN] = self
+
+    def add_lights(self, entity_ids) -> None:
+        for entity_id in entity_ids:
+            self._entities[entity_id] = FakeLightEntity(self, entity_id)
+
+    def get_entity(self, entity_id):
+        # what the dispatcher calls on the light component
+        return self._entities.get(entity_id)
+
+    async def async_received(self, color):
+        self.calls += 1
+        self.received.append((time.monotonic(), tuple(color) if color else None))
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+    async def _async_turn_on(self, call):
+        self.calls += 1
+        now = time.monotonic()
+        color = call.data.get('rgb_color')
+        entity_ids = call.data.get('entity_id', [])
+        for entity_id in [entity_ids] if isinstance(entity_ids, str) else entity_ids:
+            self.received.append((now, tuple(color) if color else None))
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+
+class FakeLightEntity(LightEntity):
+    """RGB light entity that records its colours in FakeLights, one call per light like a real integration."""
+
+    _attr_supported_color_modes = {ColorMode.RGB}
+    _attr_color_mode = ColorMode.RGB
+    _attr_is_on = True
+
+    def __init__(self, lights: FakeLights, entity_id) -> None:
+        self._lights = lights
+        self.entity_id = entity_id
+
+    async def async_turn_on(self, **kwargs) -> None:
+        await self._lights.async_received(kwargs.get('rgb_color'))
+
+
+def end_to_end(served, received) -> list[float]:
+    """Latency of every received colour since the latest time the tv served that colour."""
+    by_color: dict[tuple, list[float]] = {}
+    for served_time, color in served:
+        by_color.setdefault(tuple(color), []).append(served_time)
+    latencies = []
+    for received_time, color in received:
+        times = by_color.get(color)
+        if not times:
+            continue
+        index = bisect.bisect_right(times, received_time)
+        if index:
+            latencies.append(received_time - times[index - 1])
+    return latencies
+
+
+def make_switch(hass, kind, count, tv, music_server, args, ddp_port, fake_lights):
+    if kind == 'yeelight':
+        return switch.AmbiHueYeeSwitch(
+            hass, tv, music_server, 'bench', ', '.join(fakes.bulb_ips(count)), args.region, None, 1, 100, args.change_threshold
+        )
+    if kind == 'ddp':
+        sides = [side for side, pixels in fakes.TOPOLOGIES[args.sides]]
+        return switch.AmbiHueUdpSwitch(hass, tv, 'bench', '127.0.0.1', 'ddp', sides, None, count, 100, port=ddp_port) # the fake controller listens on a random port
+    lights = ['light.bench_' + str(i) for i in range(count)]
+    for light in lights:
+        hass.states.async_set(light, STATE_ON)
+    fake_lights.add_lights(lights)
+    switch_class = switch.AmbiHueRgbLightSwitch if kind == 'rgb' else switch.AmbiHueCtLightSwitch
+    return switch_class(
+        hass, tv, 'bench', lights, args.region, None, 1, 100, args.change_threshold, switch.DEFAULT_MAX_STALENESS,
+        direct_updates=args.direct_updates
+    )
+
+
+async def async_run_scenario(kind, count, args) -> dict:
+    conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=fakes.serve, args=(child_conn, args.sides, args.tv_frame_rate, args.recording, count if kind == 'yeelight' else 0)
+    )
+    process.start()
+    port, ddp_port = await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = await async_create_hass(config_dir)
+        lights = FakeLights(hass, args.light_latency, args.direct_updates)
+        music_server = yeelight_async.MusicServer()
+        tv = switch.AmbiHue(
+            hass, '127.0.0.1', 5, 'user', 'pass', args.vectorized, args.frame_rate, None, switch.TIMEOUT, args.fast_decode, port=port
+        ) # api version 5 is plain http, the fake tv listens on a random port
+        entity = make_switch(hass, kind, count, tv, music_server, args, ddp_port, lights)
+        entity.hass = hass
+        entity.entity_id = 'switch.bench'
+        await entity.async_added_to_hass()
+        await entity.async_turn_on()
+        await asyncio.sleep(1) # warm up: connections, music mode, first full layer
+
+        frames = tv.metrics.frames
+        cpu = time.process_time()
+        await asyncio.sleep(args.duration)
+        cpu = time.process_time() - cpu
+        frames = tv.metrics.frames - frames
+
+        get_rgb = await async_time_get_rgb(tv, args)
+        await entity.async_will_remove_from_hass()
+        await music_server.async_stop()
+        await hass.async_stop(force=True)
+
+    conn.send('stop')
+    records = conn.recv()
+    process.join()
+
+    if kind == 'yeelight':
+        received = [sample for samples in records['bulbs'].values() for sample in samples]
+        commands = records['bulb_commands']
+    elif kind == 'ddp':
+        received = records['ddp']
+        commands = records['ddp_datagrams']
+    else:
+        received = lights.received
+        commands = lights.calls
+    latencies = sorted(end_to_end(records['served'], received))
+    return {
+        'kind': kind,
+        'lights': count,
+        'fps': frames / args.duration,
+        'cpu_ms': cpu / frames * 1000 if frames else float('nan'),
+        'e2e_p50': statistics.median(latencies) * 1000 if latencies else None,
+        'e2e_p95': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+        'commands': commands,
+        'tv_requests': records['tv_requests'],
+        'get_rgb_us': get_rgb,
+    }
+
+
+async def async_time_get_rgb(tv, args) -> float:
+    # the one-off extraction, on a layer of the configured topology
+    layer1 = fakes.synthetic_layer(fakes.TOPOLOGIES[args.sides], fakes.frame_color(1))
+    number = 200
+    start = timeit.default_timer()
+    for _ in range(number):
+        await tv.async_get_rgb(layer1, args.region)
+    return (timeit.default_timer() - start) / number * 1e6
+
+
+def format_ms(value) -> str:
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--kinds', default=','.join(KINDS), help='comma separated: ' + ', '.join(KINDS))
+    parser.add_argument('--lights', default='1,10,50', help='comma separated numbers of lights (1-50)')
+    parser.add_argument('--duration', type=float, default=5, help='seconds measured per scenario')
+    parser.add_argument('--frame-rate', type=float, default=10, help='frame_rate of the integration')
+    parser.add_argument('--tv-frame-rate', type=float, default=100, help='rate the fake tv picture changes at')
+    parser.add_argument('--sides', type=int, default=3, choices=sorted(fakes.TOPOLOGIES))
+    parser.add_argument('--recording', help='replay the frames of a recording (record_file, or one layer1 JSON object per line) instead of synthetic ones')
+    parser.add_argument('--region', default='top-average', help='ambi_region of the switch')
+    parser.add_argument('--change-threshold', type=float, default=0)
+    parser.add_argument('--light-latency', type=float, default=0.01, help='seconds the fake light service (or entity) takes')
+    parser.add_argument('--direct-updates', action='store_true', help='turn the rgb and ct lights on as entities instead of through the service')
+    parser.add_argument('--vectorized', action='store_true')
+    parser.add_argument('--fast-decode', action='store_true')
+    parser.add_argument('--min-fps', type=float, help='fail when a scenario reaches a lower frame rate')
+    parser.add_argument('--max-cpu-ms', type=float, help='fail when a scenario needs more CPU time per frame')
+    args = parser.parse_args()
+
+    print('{:<10}{:>7}{:>8}{:>12}{:>10}{:>10}{:>10}{:>12}'.format('kind', 'lights', 'fps', 'cpu ms/fr', 'e2e p50', 'e2e p95', 'commands', 'get_rgb us'))
+    failed = False
+    for kind in args.kinds.split(','):
+        for count in (int(count) for count in args.lights.split(',')):
+            result = asyncio.run(async_run_scenario(kind, count, args))
+            print('{:<10}{:>7}{:>8.1f}{:>12.2f}{:>10}{:>10}{:>10}{:>12.1f}'.format(
+                kind, count, result['fps'], result['cpu_ms'], format_ms(result['e2e_p50']), format_ms(result['e2e_p95']),
+                result['commands'], result['get_rgb_us']))
+            if args.min_fps is not None and result['fps'] < args.min_fps:
+                failed = True
+            if args.max_cpu_ms is not None and not result['cpu_ms'] <= args.max_cpu_ms:
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""Stand-ins for a Philips JointSpace TV and Yeelight bulbs, using nothing but the standard library.
+
+FakeTV serves the JointSpace endpoints the integration polls over plain HTTP/1.1 with keep-alive,
+with synthetic frames (every pixel of frame k has colour frame_color(k)) or frames replayed from a
+file with one layer1 JSON object per line, or a recording made with the record_file option. FakeBulb speaks the Yeelight LAN protocol, including
+music mode, and timestamps every colour it receives. FakeDdpController receives the DDP output.
+
+Bulbs listen on their own loopback address (127.0.0.2, 127.0.0.3, ...) on the normal yeelight port,
+Linux routes all of 127.0.0.0/8 to the loopback interface.
+"""
+import asyncio
+import importlib
+import json
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'custom_components'))
+
+YEELIGHT_PORT = 55443
+DDP_HEADER = struct.Struct('>BBBBIH') # flags, sequence, data type, output id, data offset, data length
+DDP_PUSH = 0x01
+TOPOLOGIES = {
+    2: (('left', 5), ('right', 5)),
+    3: (('left', 4), ('top', 9), ('right', 4)),
+    4: (('left', 6), ('top', 14), ('right', 6), ('bottom', 14)),
+}
+
+
+def frame_color(k) -> tuple:
+    # consecutive frames differ clearly (so no change threshold hides them), the cycle repeats after 256 frames
+    k = k % 255 + 1
+    return (k * 53) % 256, (k * 101) % 256, (k * 197) % 256
+
+
+def synthetic_layer(topology, color) -> dict:
+    r, g, b = color
+    return {side: {str(i): {'r': r, 'g': g, 'b': b} for i in range(count)} for side, count in topology}
+
+
+def load_recording(path) -> list:
+    """Load the layer1 frames of a recording of the integration (record_file) or of a file with one JSON frame per line."""
+    recording = importlib.import_module('philips_ambilight+yeelight.recording')
+    with open(path, 'rb') as file:
+        binary = file.read(len(recording.MAGIC)) == recording.MAGIC
+    if binary:
+        return [
+            {side: {str(i): {'r': pixels[i * 3], 'g': pixels[i * 3 + 1], 'b': pixels[i * 3 + 2]} for i in range(len(pixels) // 3)} for side, pixels in frame.items()}
+            for timestamp, configuration, frame in recording.read_recording(path)
+        ]
+    layers = []
+    with open(path) as recording:
+        for line in recording:
+            if line.strip():
+                layer = json.loads(line)
+                layers.append(layer.get('layer1', layer))
+    return layers
+
+
+class FakeTV:
+    """Serves /<api>/ambilight/measured (and processed, and per side) plus the state endpoints."""
+
+    def __init__(self, sides=3, tv_frame_rate=100, recording=None) -> None:
+        self._topology = TOPOLOGIES[sides]
+        self._tv_frame_rate = tv_frame_rate # rate the picture of the fake tv changes at
+        self._recording = load_recording(recording) if recording else None
+        self._start = time.monotonic()
+        self._server = None
+        self.served: list[tuple] = [] # (monotonic time, colour) of every synthetic frame served
+        self.requests = 0
+        self.state = {
+            'ambilight/currentconfiguration': {'styleName': 'FOLLOW_VIDEO', 'isExpert': False, 'menuSetting': 'STANDARD'},
+            'powerstate': {'powerstate': 'On'},
+            'ambilight/power': {'power': 'On'},
+        }
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def async_start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._on_connect, host, port)
+
+    async def async_stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _layer(self):
+        k = int((time.monotonic() - self._start) * self._tv_frame_rate)
+        if self._recording:
+            return self._recording[k % len(self._recording)]
+        color = frame_color(k)
+        self.served.append((time.monotonic(), color))
+        return synthetic_layer(self._topology, color)
+
+    def _get(self, path):
+        # path without the api version, e.g. 'ambilight/measured/layer1/left'
+        if path in self.state:
+            return self.state[path]
+        for base in ('ambilight/measured', 'ambilight/processed'):
+            if path == base:
+                return {'layer1': self._layer()}
+            if path.startswith(base + '/layer1/'):
+                side = path[len(base + '/layer1/'):]
+                layer = self._layer()
+                return {'layer1': {side: layer[side]}} if side in layer else None
+        return None
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                method, target = request.split(b' ', 2)[:2]
+                self.requests += 1
+                body = self._get(target.decode().split('/', 2)[-1]) if method == b'GET' else None
+                if body is None:
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                else:
+                    payload = json.dumps(body).encode()
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: '
+                                 + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass # closed by the client, or the fake is shutting down
+        finally:
+            writer.close()
+
+
+class FakeBulb:
+    """Yeelight LAN protocol stand-in that records the time and colour of every start_cf it receives."""
+
+    def __init__(self, ip, port=YEELIGHT_PORT) -> None:
+        self.ip = ip
+        self._port = port
+        self._server = None
+        self._music_writer = None
+        self._tasks = set()
+        self.properties = {'power': 'off', 'bright': '50', 'rgb': '16777215', 'color_mode': '1', 'music_on': '0'}
+        self.received: list[tuple] = [] # (monotonic time, (r, g, b))
+        self.commands = 0
+
+    async def async_start(self):
+        self._server = await asyncio.start_server(self._on_connect, self.ip, self._port)
+
+    async def async_stop(self):
+        if self._music_writer is not None:
+            self._music_writer.close()
+        for task in self._tasks:
+            task.cancel()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _handle(self, message) -> list:
+        self.commands += 1
+        method, params = message.get('method'), message.get('params', [])
+        if method == 'get_prop':
+            return [self.properties.get(name, '') for name in params]
+        if method == 'set_power':
+            self.properties['power'] = params[0]
+        elif method == 'set_bright':
+            self.properties['bright'] = str(params[0])
+        elif method == 'start_cf':
+            value = int(params[2].split(',')[2]) # expression: duration, mode, value, brightness
+            self.received.append((time.monotonic(), (value >> 16 & 255, value >> 8 & 255, value & 255)))
+        elif method == 'set_music':
+            if params[0] == 1:
+                self._spawn(self._async_music(params[1], params[2]))
+            elif self._music_writer is not None:
+                self._music_writer.close()
+                self._music_writer = None
+                self.properties['music_on'] = '0'
+        return ['ok']
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _async_music(self, host, port):
+        # in music mode the bulb connects back to the host, from its own address
+        reader, self._music_writer = await asyncio.open_connection(host, port, local_addr=(self.ip, 0))
+        self.properties['music_on'] = '1'
+        try:
+            while line := await reader.readline():
+                self._handle(json.loads(line))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                writer.write((json.dumps({'id': message['id'], 'result': self._handle(message)}) + '\r\n').encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass # closed by the client, or the fake is shutting down
+        finally:
+            writer.close()
+
+
+class FakeDdpController(asyncio.DatagramProtocol):
+    """DDP receiver that records the time and the colour of the first pixel of every frame it shows."""
+
+    def __init__(self) -> None:
+        self._transport = None
+        self._first = None
+        self.received: list[tuple] = [] # (monotonic time, (r, g, b))
+        self.datagrams = 0
+
+    @property
+    def port(self) -> int:
+        return self._transport.get_extra_info('sockname')[1]
+
+    async def async_start(self, host='127.0.0.1', port=0):
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: self, local_addr=(host, port))
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        self.datagrams += 1
+        flags, sequence, data_type, output, offset, length = DDP_HEADER.unpack_from(data)
+        if offset == 0 and length >= 3:
+            self._first = tuple(data[DDP_HEADER.size:DDP_HEADER.size + 3])
+        if flags & DDP_PUSH and self._first is not None:
+            self.received.append((time.monotonic(), self._first))
+
+    def stop(self):
+        self._transport.close()
+
+
+def bulb_ips(count) -> list[str]:
+    return ['127.0.0.' + str(i + 2) for i in range(count)]
+
+
+async def async_serve(conn, sides, tv_frame_rate, recording, bulbs):
+    tv = FakeTV(sides, tv_frame_rate, recording)
+    await tv.async_start()
+    fake_bulbs = [FakeBulb(ip) for ip in bulb_ips(bulbs)]
+    for bulb in fake_bulbs:
+        await bulb.async_start()
+    controller = FakeDdpController()
+    await controller.async_start()
+    conn.send((tv.port, controller.port))
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv) # wait for 'stop'
+    conn.send({
+        'served': tv.served,
+        'tv_requests': tv.requests,
+        'bulbs': {bulb.ip: bulb.received for bulb in fake_bulbs},
+        'bulb_commands': sum(bulb.commands for bulb in fake_bulbs),
+        'ddp': controller.received,
+        'ddp_datagrams': controller.datagrams,
+    })
+    controller.stop()
+    for bulb in fake_bulbs:
+        await bulb.async_stop()
+    await tv.async_stop()
+
+
+def serve(conn, sides=3, tv_frame_rate=100, recording=None, bulbs=0):
+    """Entry point of the fake device process: sends the tv's and the ddp controller's port, then the records after receiving 'stop'."""
+    asyncio.run(async_serve(conn, sides, tv_frame_rate, recording, bulbs))
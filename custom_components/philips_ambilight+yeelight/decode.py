@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import json
+from array import array
+
+try:
+    import orjson
+except ImportError: # orjson is optional (but ships with home assistant), json is the fallback
+    orjson = None
+
+SIDES = ('left', 'top', 'right', 'bottom')
+
+_SIDE_KEYS = tuple((side, ('"' + side + '"').encode()) for side in SIDES)
+_DIGITS = bytes(c if 48 <= c <= 57 else 32 for c in range(256)) # translation table blanking everything but digits
+_INDEXES = [str(i).encode() for i in range(256)]
+_VALUES = {key: i for i, key in enumerate(_INDEXES)} # a dict lookup is much cheaper than int() on bytes
+
+def loads(raw):
+    """Decode JSON with orjson when it is installed."""
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def flatten_layer(layer1) -> dict[str, array]:
+    """Convert a decoded {'left': {'0': {'r':..,'g':..,'b':..}, ...}, ...} layer to compact frames."""
+    frame = {}
+    for side in SIDES:
+        if side in layer1:
+            pixels = layer1[side]
+            flat = array('B')
+            for index in range(len(pixels)):
+                pixel = pixels[str(index)]
+                flat.extend((pixel['r'], pixel['g'], pixel['b']))
+            frame[side] = flat
+    return frame
+
+
+def _decode_side(raw: bytes) -> array:
+    # a side is a run of '"<index>": {"r": <r>, "g": <g>, "b": <b>}', so its numbers come in groups of 4
+    numbers = raw.translate(_DIGITS).split()
+    if len(numbers) % 4 or numbers[0::4] != _INDEXES[:len(numbers) // 4]:
+        raise ValueError('Unexpected pixel layout')
+    del numbers[0::4]
+    return array('B', map(_VALUES.__getitem__, numbers))
+
+
+def decode_frame(raw: bytes, side=None) -> dict[str, array]:
+    """Decode an ambilight measured/processed response straight into compact frames.
+
+    A frame maps each side to an array of bytes [r, g, b, r, g, b, ...] in pixel order.
+    With orjson installed the response is decoded with orjson and flattened, which is as fast as
+    the scanner or faster (see benchmarks/bench_decode.py), otherwise with scan_frame().
+    `side` names the side of a response for a single side (e.g. 'ambilight/measured/layer1/left').
+    """
+    if orjson is not None:
+        return _flatten_response(orjson.loads(raw), side)
+    return scan_frame(raw, side)
+
+
+def scan_frame(raw: bytes, side=None) -> dict[str, array]:
+    """Like decode_frame(), but scanning the numbers out of the response without building the intermediate dicts.
+
+    Faster than the json module, it relies on the layout JointSpace tv's send (pixels in index
+    order, channels in r, g, b order) and falls back to a full JSON decode otherwise.
+    """
+    try:
+        if not -1 < raw.find(b'"r"') < raw.find(b'"g"') < raw.find(b'"b"'):
+            raise ValueError('Unexpected channel order')
+        marks = sorted(mark for mark in ((raw.find(key), side, len(key)) for side, key in _SIDE_KEYS) if mark[0] >= 0)
+        if not marks:
+            if side is None:
+                raise ValueError('No sides found')
+            return {side: _decode_side(raw)}
+        ends = [start for start, name, length in marks[1:]] + [len(raw)]
+        return {name: _decode_side(raw[start + length:end]) for (start, name, length), end in zip(marks, ends)}
+    except (ValueError, KeyError): # KeyError: a channel outside 0-255
+        return _flatten_response(loads(raw), side)
+
+
+def _flatten_response(data, side=None) -> dict[str, array]:
+    data = data.get('layer1', data)
+    if side is not None and side not in data:
+        data = {side: data}
+    return flatten_layer(data)
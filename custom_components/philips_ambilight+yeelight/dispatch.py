@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import Callable
+
+from homeassistant.components.light import (
+    ATTR_BRIGHTNESS,
+    ATTR_HS_COLOR,
+    ATTR_RGB_COLOR,
+    ATTR_TRANSITION,
+    ATTR_XY_COLOR,
+    ColorMode,
+    LightEntity,
+    LightEntityFeature)
+from homeassistant.components.light import DOMAIN as LIGHT_DOMAIN
+from homeassistant.const import ATTR_ENTITY_ID, SERVICE_TURN_ON
+from homeassistant.core import HomeAssistant
+import homeassistant.util.color as color_util
+
+from .metrics import Metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+SERVICE_TIMEOUT = 2 # seconds before a light service call is cancelled
+RTT_FACTOR = 1.5 # a device gets at most one update per this many measured round-trip times
+ERROR_PENALTY = 4 # the update interval is multiplied by up to 1 + this for a device that keeps failing
+MAX_INTERVAL = 5.0 # seconds, the slowest update rate a device is throttled to
+SMOOTHING = 0.2 # weight of the newest sample in the latency and error rate averages
+ERROR_INTERVAL = 0.5 # seconds, the shortest update interval of a device that failed recently
+ERROR_THRESHOLD = 0.01 # error rate below which a device counts as healthy again (the average never quite reaches 0)
+
+
+class RateLimiter:
+    """Caps the update rate of one output device based on its measured command latency and error rate.
+
+    Devices that answer quickly keep up with every frame, slow or failing ones (a busy Zigbee mesh,
+    a yeelight outside music mode) are throttled instead of being flooded with commands they drop.
+    """
+
+    def __init__(self) -> None:
+        self.rtt: float | None = None # moving average of the round-trip time in seconds
+        self.error_rate = 0.0 # moving average of the share of failed commands
+        self._last: float | None = None
+
+    @property
+    def interval(self) -> float:
+        interval = (self.rtt or 0) * RTT_FACTOR * (1 + ERROR_PENALTY * self.error_rate)
+        if self.error_rate > ERROR_THRESHOLD: # also for devices that never answered, so have no rtt yet
+            interval = max(interval, ERROR_INTERVAL * (1 + ERROR_PENALTY * self.error_rate))
+        return min(interval, MAX_INTERVAL)
+
+    @property
+    def rate(self) -> float | None:
+        """Maximum number of updates per second, None while it is not limited."""
+        return None if self.interval == 0 else round(1 / self.interval, 2)
+
+    def ready(self, now, min_interval=0) -> bool:
+        return self.wait(now, min_interval) <= 0
+
+    def wait(self, now, min_interval=0) -> float:
+        """Seconds until the device may get its next update."""
+        if self._last is None:
+            return 0.0
+        return self._last + max(self.interval, min_interval) - now
+
+    def started(self, now) -> None:
+        self._last = now
+
+    def record(self, rtt, success) -> None:
+        """Record a command, rtt is the time it took, also when it failed (e.g. the timeout it ran into)."""
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.rtt + SMOOTHING * (rtt - self.rtt)
+        self.error_rate += SMOOTHING * ((0 if success else 1) - self.error_rate)
+
+    def as_dict(self) -> dict:
+        return {
+            'max_update_rate': self.rate,
+            'latency_ms': None if self.rtt is None else round(self.rtt * 1000),
+            'error_rate': round(self.error_rate, 2),
+        }
+
+
+def light_params(entity: LightEntity, service_data) -> dict | None:
+    """Arguments for a light entity's async_turn_on, converted to its colour modes like the light.turn_on service does.
+
+    Returns None for lights that need a conversion only the service does (e.g. rgbw lights).
+    """
+    modes = entity.supported_color_modes or set()
+    params = {}
+    for key, value in service_data.items():
+        if key == ATTR_TRANSITION:
+            if entity.supported_features & LightEntityFeature.TRANSITION:
+                params[key] = value
+        elif key == ATTR_RGB_COLOR:
+            if ColorMode.RGB in modes:
+                params[key] = value
+            elif ColorMode.HS in modes:
+                params[ATTR_HS_COLOR] = color_util.color_RGB_to_hs(*value)
+            elif ColorMode.XY in modes:
+                params[ATTR_XY_COLOR] = color_util.color_RGB_to_xy(*value)
+            else:
+                return None
+        elif key == ATTR_BRIGHTNESS:
+            if not modes - {ColorMode.ONOFF, ColorMode.UNKNOWN}:
+                return None
+            params[key] = value
+        else:
+            params[key] = value
+    return params
+
+
+class LightDispatcher:
+    """Sends the light service calls of the follow loop without ever waiting on them.
+
+    Every light has one dispatch slot: while a call for a light is in flight, newer frames only
+    replace its pending value (latest value wins) and the newest one is sent as soon as the light
+    is free again. Slow lights therefore get fewer updates instead of a growing queue, and fast
+    lights get all of them. Lights that are free and want the same service data are turned on with
+    a single call, so the number of calls grows with the number of distinct colours. The on_sent
+    callback of a queued value is called once its call succeeded.
+
+    Lights resolved with resolve() skip the light.turn_on service: their entity is turned on directly,
+    without a call_service event, schema validation or the refresh the service does after every call.
+    They get a single state write with their final state when they are no longer followed.
+    """
+
+    def __init__(self, hass: HomeAssistant, metrics: Metrics | None = None) -> None:
+        self._hass = hass
+        self._metrics = metrics
+        self._frame_times: dict[str, float | None] = {} # entity id -> time the frame of its pending value was requested
+        self._pending: dict[str, tuple] = {} # entity id -> service data items still to send
+        self._on_sent: dict[str, Callable | None] = {} # entity id -> callback of its pending value
+        self._sending: dict[str, Callable | None] = {} # entity id -> callback of its value in flight
+        self._in_flight: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._limiters: dict[str, RateLimiter] = {}
+        self._entities: dict[str, LightEntity] = {} # entity id -> light entity that is turned on directly
+        self._updated: set[str] = set() # directly turned on lights whose state hasn't been written since
+
+    def get_limiter(self, entity_id) -> RateLimiter:
+        if entity_id not in self._limiters:
+            self._limiters[entity_id] = RateLimiter()
+        return self._limiters[entity_id]
+
+    def resolve(self, entity_ids) -> None:
+        """Look the light entities up once, so their updates call the entities directly instead of the service."""
+        component = self._hass.data.get(LIGHT_DOMAIN)
+        for entity_id in entity_ids:
+            entity = component.get_entity(entity_id) if component is not None else None
+            if entity is None:
+                _LOGGER.warning('The light ' + entity_id + ' was not found, it is updated through the light.turn_on service instead.')
+                continue
+            self._entities[entity_id] = entity
+
+    def queue(self, entity_ids, service_data: dict, frame_time=None, on_sent: Callable | None = None) -> None:
+        key = tuple(sorted(service_data.items()))
+        for entity_id in entity_ids:
+            self._pending[entity_id] = key
+            self._frame_times[entity_id] = frame_time
+            self._on_sent[entity_id] = on_sent
+
+    def flush(self) -> None:
+        # lights that are busy or throttled keep their pending value for a later flush
+        now = time.monotonic()
+        groups: dict[tuple, list[str]] = {}
+        direct: list[tuple] = []
+        for entity_id, key in self._pending.items():
+            if entity_id not in self._in_flight and self.get_limiter(entity_id).ready(now):
+                params = light_params(self._entities[entity_id], dict(key)) if entity_id in self._entities else None
+                if params is None:
+                    groups.setdefault(key, []).append(entity_id)
+                else:
+                    direct.append((entity_id, params))
+        for key, entity_ids in groups.items():
+            frame_times = {entity_id: self._start(entity_id, now) for entity_id in entity_ids}
+            self._create_task(self._async_call(entity_ids, dict(key), frame_times))
+        for entity_id, params in direct:
+            frame_time = self._start(entity_id, now)
+            self._create_task(self._async_call_entity(entity_id, params, frame_time))
+
+    def _start(self, entity_id, now) -> float | None:
+        # moves a light from pending to in flight, returns the frame time of its value
+        del self._pending[entity_id]
+        self._sending[entity_id] = self._on_sent.pop(entity_id, None)
+        self._limiters[entity_id].started(now)
+        self._in_flight.add(entity_id)
+        return self._frame_times.pop(entity_id, None)
+
+    def _create_task(self, coroutine) -> None:
+        task = self._hass.async_create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _async_call(self, entity_ids, service_data, frame_times=None):
+        start = time.monotonic()
+        success = False
+        try:
+            await asyncio.wait_for(
+                self._hass.services.async_call(LIGHT_DOMAIN, SERVICE_TURN_ON, {**service_data, ATTR_ENTITY_ID: entity_ids}, blocking=True),
+                SERVICE_TIMEOUT,
+            )
+            success = True
+        except asyncio.CancelledError:
+            raise # following stopped, not a failure of the lights, cancel() already freed their slots
+        except asyncio.TimeoutError:
+            _LOGGER.debug('Timed out setting ' + ', '.join(entity_ids))
+        except Exception as e:
+            _LOGGER.error('Unable to set the light colors ' + str(e))
+        self._finished(entity_ids, time.monotonic() - start, success, frame_times)
+
+    async def _async_call_entity(self, entity_id, params, frame_time=None):
+        entity = self._entities[entity_id]
+        start = time.monotonic()
+        success = False
+        try:
+            # async_request_call keeps to the integration's limit of parallel updates, like the service does
+            await asyncio.wait_for(entity.async_request_call(entity.async_turn_on(**params)), SERVICE_TIMEOUT)
+            self._updated.add(entity_id)
+            success = True
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            _LOGGER.debug('Timed out setting ' + entity_id)
+        except Exception as e:
+            _LOGGER.error('Unable to set the light colors ' + str(e))
+        self._finished([entity_id], time.monotonic() - start, success, {entity_id: frame_time})
+
+    def _finished(self, entity_ids, rtt, success, frame_times=None) -> None:
+        callbacks = {} # lights queued together share their callback, it is called once
+        for entity_id in entity_ids:
+            self.get_limiter(entity_id).record(rtt, success)
+            if self._metrics is not None:
+                self._metrics.command(entity_id, rtt, success, (frame_times or {}).get(entity_id))
+            on_sent = self._sending.pop(entity_id, None)
+            if success and on_sent is not None:
+                callbacks[id(on_sent)] = on_sent
+        self._in_flight.difference_update(entity_ids)
+        for on_sent in callbacks.values():
+            on_sent()
+        if any(entity_id in self._pending for entity_id in entity_ids):
+            self.flush()
+
+    def commit(self, entity_ids) -> None:
+        """Write the current state of the directly turned on lights, once, e.g. when following stops."""
+        for entity_id in entity_ids:
+            entity = self._entities.get(entity_id)
+            if entity_id in self._updated and entity is not None and entity.hass is not None:
+                entity.async_schedule_update_ha_state(entity.should_poll) # polled lights are refreshed first
+            self._updated.discard(entity_id)
+
+    def discard(self, entity_ids) -> None:
+        # drops values not sent yet, e.g. for lights that are being turned off
+        for entity_id in entity_ids:
+            self._pending.pop(entity_id, None)
+            self._frame_times.pop(entity_id, None)
+            self._on_sent.pop(entity_id, None)
+        self.commit(entity_ids)
+        for entity_id in entity_ids:
+            self._entities.pop(entity_id, None) # resolved again when followed again, the entity may have been reloaded
+
+    def cancel(self) -> None:
+        # a task cancelled before it started never gets to _finished, so the slots are freed here
+        self._pending.clear()
+        self._frame_times.clear()
+        self._on_sent.clear()
+        self._sending.clear()
+        self._in_flight.clear()
+        for task in self._tasks:
+            task.cancel()
+        self.commit(list(self._updated))
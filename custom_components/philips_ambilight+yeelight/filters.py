@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import math
+import time
+
+DEFAULT_CHANGE_THRESHOLD = 2.0 # CIE76 delta-E, around 2.3 is the smallest difference most people notice
+DEFAULT_MAX_STALENESS = 10 # seconds after which an unchanged colour is sent again anyway
+
+# sRGB channel (0-255) -> linear light, see https://en.wikipedia.org/wiki/SRGB
+_LINEAR = [c / 255 / 12.92 if c / 255 <= 0.04045 else ((c / 255 + 0.055) / 1.055) ** 2.4 for c in range(256)]
+
+
+def _lab_f(t):
+    return t ** (1 / 3) if t > 216 / 24389 else (24389 / 27 * t + 16) / 116
+
+
+def rgb_to_lab(r, g, b) -> tuple:
+    """Convert an sRGB colour to CIELAB (D65), where distances roughly match perceived differences."""
+    rl, gl, bl = _LINEAR[min(255, int(r))], _LINEAR[min(255, int(g))], _LINEAR[min(255, int(b))]
+    fx = _lab_f((0.4124 * rl + 0.3576 * gl + 0.1805 * bl) / 0.95047)
+    fy = _lab_f(0.2126 * rl + 0.7152 * gl + 0.0722 * bl)
+    fz = _lab_f((0.0193 * rl + 0.1192 * gl + 0.9505 * bl) / 1.08883)
+    return 116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)
+
+
+class ChangeGate:
+    """Suppresses light updates that are perceptually too close to the last one sent.
+
+    A colour passes when its delta-E to the last sent colour, or the change in brightness
+    (in percent), exceeds the threshold, or when the last update is older than max_staleness.
+    A threshold of 0 passes every change.
+    """
+
+    def __init__(self, threshold=DEFAULT_CHANGE_THRESHOLD, max_staleness=DEFAULT_MAX_STALENESS) -> None:
+        self._threshold = threshold
+        self._max_staleness = max_staleness
+        self._rgb = None
+        self._lab = None
+        self._brightness = None
+        self._time = None
+
+    def is_update_needed(self, r, g, b, brightness) -> bool:
+        if self._time is None or time.monotonic() - self._time > self._max_staleness:
+            return True
+        if abs(brightness - self._brightness) / 254 * 100 > self._threshold:
+            return True
+        if (r, g, b) == self._rgb:
+            return False
+        if r is None or self._rgb[0] is None:
+            return True
+        if self._threshold == 0:
+            return True
+        lab_l, lab_a, lab_b = rgb_to_lab(r, g, b)
+        last_l, last_a, last_b = self._lab
+        return ((lab_l - last_l) ** 2 + (lab_a - last_a) ** 2 + (lab_b - last_b) ** 2) ** 0.5 > self._threshold
+
+    def sent(self, r, g, b, brightness) -> None:
+        """Record the values of a successful update."""
+        if (r, g, b) != self._rgb:
+            self._rgb = (r, g, b)
+            self._lab = None if r is None else rgb_to_lab(r, g, b)
+        self._brightness = brightness
+        self._time = time.monotonic()
+
+
+FILTER_EMA = 'ema'
+FILTER_ONE_EURO = 'one_euro'
+FILTER_MEDIAN = 'median'
+FILTERS = (FILTER_EMA, FILTER_ONE_EURO, FILTER_MEDIAN)
+
+
+class EmaFilter:
+    """Exponential moving average, higher alpha follows the tv faster."""
+
+    def __init__(self, alpha=0.5) -> None:
+        self._alpha = alpha
+        self._state = [0.0, 0.0, 0.0]
+        self._primed = False
+
+    def reset(self):
+        self._primed = False
+
+    def apply(self, r, g, b):
+        state = self._state
+        if not self._primed:
+            state[0], state[1], state[2] = r, g, b
+            self._primed = True
+            return r, g, b
+        alpha = self._alpha
+        state[0] += alpha * (r - state[0])
+        state[1] += alpha * (g - state[1])
+        state[2] += alpha * (b - state[2])
+        return int(state[0] + 0.5), int(state[1] + 0.5), int(state[2] + 0.5)
+
+
+class MedianFilter:
+    """Median of the last `window` frames per channel, removes single-frame spikes."""
+
+    def __init__(self, window=3) -> None:
+        self._window = window
+        self._history = [[0] * window for channel in range(3)]
+        self._scratch = [0] * window
+        self._index = 0
+        self._count = 0
+
+    def reset(self):
+        self._index = 0
+        self._count = 0
+
+    def _median(self, history):
+        if self._count < self._window: # still filling up the window
+            return sorted(history[:self._count])[self._count // 2]
+        scratch = self._scratch
+        scratch[:] = history
+        scratch.sort()
+        return scratch[self._window // 2]
+
+    def apply(self, r, g, b):
+        history = self._history
+        index = self._index
+        history[0][index], history[1][index], history[2][index] = r, g, b
+        self._index = (index + 1) % self._window
+        if self._count < self._window:
+            self._count += 1
+        return self._median(history[0]), self._median(history[1]), self._median(history[2])
+
+
+class OneEuroFilter:
+    """One euro filter (see: https://gery.casiez.net/1euro/), smooths slow drifts strongly and lets fast changes through.
+
+    min_cutoff (Hz) sets the smoothing of a static picture, beta how quickly the cutoff rises with the speed of change.
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.01, d_cutoff=1.0) -> None:
+        self._min_cutoff = min_cutoff
+        self._beta = beta
+        self._d_cutoff = d_cutoff
+        self._value = [0.0, 0.0, 0.0]
+        self._speed = [0.0, 0.0, 0.0]
+        self._time = None
+
+    def reset(self):
+        self._time = None
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1 / (2 * math.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+    def _channel(self, channel, x, dt, d_alpha):
+        previous = self._value[channel]
+        speed = self._speed[channel] + d_alpha * ((x - previous) / dt - self._speed[channel])
+        self._speed[channel] = speed
+        value = previous + self._alpha(self._min_cutoff + self._beta * abs(speed), dt) * (x - previous)
+        self._value[channel] = value
+        return int(value + 0.5)
+
+    def apply(self, r, g, b):
+        now = time.monotonic()
+        if self._time is None or now <= self._time:
+            value, speed = self._value, self._speed
+            value[0], value[1], value[2] = r, g, b
+            speed[0] = speed[1] = speed[2] = 0.0
+            self._time = now
+            return r, g, b
+        dt = now - self._time
+        self._time = now
+        d_alpha = self._alpha(self._d_cutoff, dt)
+        return self._channel(0, r, dt, d_alpha), self._channel(1, g, dt, d_alpha), self._channel(2, b, dt, d_alpha)
+
+
+def make_filter(config):
+    """Build the smoothing filter described by a listener's 'filter' configuration, None if there is none."""
+    if not config:
+        return None
+    if config['type'] == FILTER_EMA:
+        return EmaFilter(config['alpha'])
+    if config['type'] == FILTER_MEDIAN:
+        return MedianFilter(config['window'])
+    if config['type'] == FILTER_ONE_EURO:
+        return OneEuroFilter(config['min_cutoff'], config['beta'])
+    raise ValueError('Unknown filter ' + str(config['type']))
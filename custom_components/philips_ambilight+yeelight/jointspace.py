@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+import httpx
+
+from homeassistant.core import HomeAssistant
+from homeassistant.util.ssl import get_default_no_verify_context
+
+from .decode import decode_frame, loads
+
+_LOGGER = logging.getLogger(__name__)
+
+BASE_URL, PORT = 'https://{0}:{1}/{2}/{3}', 1926 # api version 6 and up (secured)
+LEGACY_BASE_URL, LEGACY_PORT = 'http://{0}:{1}/{2}/{3}', 1925 # for older philips tv's (api version 1 to 5)
+TIMEOUT = 5.0 # get/post request timeout with tv
+CONNFAILCOUNT = 5 # number of get/post attempts of state and configuration requests, frames are never retried
+RETRY_BACKOFF = 0.2 # seconds, times the attempt, waited before retrying a request
+MAX_CONNECTIONS = 4 # kept alive to the tv, so state requests don't wait for a frame
+
+
+class JointSpaceClient:
+    """Long-lived HTTP client for the JointSpace API of one TV.
+
+    The connections (and their TLS sessions) are kept alive between frames, and httpx's digest
+    auth reuses the last challenge, so after the first request no frame pays for a TLS handshake
+    or a 401 round-trip. The client is owned by this class (not shared by home assistant), so
+    async_reset really closes its connections.
+    """
+
+    def __init__(self, hass: HomeAssistant, host, api_version, username, password, timeout=TIMEOUT, retries=CONNFAILCOUNT, port=None) -> None:
+        self._hass = hass
+        self._host = host
+        self._api_version = int(api_version)
+        self._username = username
+        self._password = password
+        self._timeout = timeout
+        self._retries = retries
+        self._base_url = BASE_URL if self._api_version >= 6 else LEGACY_BASE_URL
+        self._port = port or (PORT if self._api_version >= 6 else LEGACY_PORT) # another port e.g. for a simulated tv
+        self._client: httpx.AsyncClient | None = None
+        self._sides_supported = True
+        self.decode_time = 0.0 # seconds spent decoding the last layer
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                verify=get_default_no_verify_context(), # the tv uses a self-signed certificate
+                auth=httpx.DigestAuth(self._username, self._password) if self._api_version >= 6 else None,
+                timeout=httpx.Timeout(self._timeout),
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+            )
+        return self._client
+
+    def url(self, path) -> str:
+        return self._base_url.format(self._host, self._port, self._api_version, path)
+
+    async def async_get_raw(self, path, retries=None) -> bytes:
+        """GET a path, retrying connection failures up to retries (default CONNFAILCOUNT) times with a short backoff."""
+        client = self._get_client()
+        retries = self._retries if retries is None else retries
+        for attempt in range(1, retries + 1):
+            try:
+                response = await client.get(self.url(path))
+                response.raise_for_status()
+                return response.content
+            except httpx.TransportError as e:
+                if attempt >= retries:
+                    raise
+                _LOGGER.debug('Attempt ' + str(attempt) + ' to get ' + path + ' failed: ' + str(e))
+                await asyncio.sleep(RETRY_BACKOFF * attempt)
+
+    async def async_get(self, path):
+        return loads(await self.async_get_raw(path))
+
+    async def async_get_layer(self, path, sides=None, compact=False) -> dict:
+        """Return layer1 of an ambilight path ('ambilight/measured' or 'ambilight/processed').
+
+        With a single side, only that side is requested (e.g. 'ambilight/measured/layer1/left'), falling
+        back to the full layer for tv's that don't support side specific paths. More sides are always
+        fetched as the full layer, one request is cheaper than a request per side.
+        With compact, the response is decoded straight into a compact frame (see decode.py).
+        Frames are not retried: by the time a retry answers the follow loop wants the next frame anyway.
+        """
+        if sides and len(sides) == 1 and self._sides_supported:
+            side = sides[0]
+            try:
+                response = await self.async_get_raw(path + '/layer1/' + side, retries=1)
+                start = time.monotonic()
+                layer = decode_frame(response, side) if compact else {side: self._get_side(loads(response), side)}
+                self.decode_time = time.monotonic() - start
+                return layer
+            except httpx.HTTPStatusError as e:
+                _LOGGER.warning('This TV does not support fetching single ambilight sides, fetching the full layer instead: ' + str(e))
+                self._sides_supported = False
+        response = await self.async_get_raw(path, retries=1)
+        start = time.monotonic()
+        layer = decode_frame(response) if compact else loads(response)['layer1']
+        self.decode_time = time.monotonic() - start
+        return layer
+
+    @staticmethod
+    def _get_side(response, side) -> dict:
+        # depending on the tv, the side is returned as is or still wrapped in its layer
+        response = response.get('layer1', response)
+        return response.get(side, response)
+
+    async def async_reset(self):
+        # drops the kept-alive connections and the cached auth challenge, e.g. after the tv restarted
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
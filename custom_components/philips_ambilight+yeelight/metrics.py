@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import math
+import time
+from collections import deque
+
+# stages of a frame, each with its own latency histogram
+STAGE_FETCH = 'fetch' # GET of the ambilight layer from the tv
+STAGE_DECODE = 'decode' # JSON (or compact) decoding of the layer
+STAGE_EXTRACT = 'extract' # reduction of the layer to the region colours
+STAGE_FANOUT = 'fanout' # listeners turning the colours into commands
+STAGE_COMMAND = 'command' # one command to one output device
+STAGE_END_TO_END = 'end_to_end' # from asking the tv for a frame to a device having applied it
+STAGES = (STAGE_FETCH, STAGE_DECODE, STAGE_EXTRACT, STAGE_FANOUT, STAGE_COMMAND, STAGE_END_TO_END)
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0) # seconds
+RECENT_SAMPLES = 200 # samples kept per histogram for the percentiles of the sensors
+RATE_WINDOW = 50 # frames the achieved frame rate is measured over
+
+
+class Histogram:
+    """Cumulative latency histogram (Prometheus style buckets) plus a window of recent samples."""
+
+    def __init__(self, buckets=BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._recent: deque[float] = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds) -> None:
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self._recent.append(seconds)
+
+    def percentile(self, q) -> float | None:
+        """The q-th percentile (0-100) of the recent samples, None without samples."""
+        if not self._recent:
+            return None
+        samples = sorted(self._recent)
+        return samples[max(0, math.ceil(q / 100 * len(samples)) - 1)]
+
+
+class Metrics:
+    """Counters and latency histograms of the follow loop of one tv."""
+
+    def __init__(self) -> None:
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.frames = 0
+        self.skipped_frames = 0 # frames not fetched or not sent because the loop fell behind
+        self.suppressed_updates = 0 # listener updates dropped by the change threshold
+        self.device_commands: dict[str, int] = {}
+        self.device_errors: dict[str, int] = {}
+        self._frame_times: deque[float] = deque(maxlen=RATE_WINDOW)
+
+    def observe(self, stage, seconds) -> None:
+        self.histograms[stage].observe(seconds)
+
+    def frame(self) -> None:
+        self.frames += 1
+        self._frame_times.append(time.monotonic())
+
+    def command(self, device, seconds, success, frame_time=None) -> None:
+        """Record a command to a device, frame_time is the monotonic time the frame was requested from the tv."""
+        self.device_commands[device] = self.device_commands.get(device, 0) + 1
+        if not success:
+            self.device_errors[device] = self.device_errors.get(device, 0) + 1
+            return
+        if seconds is not None:
+            self.observe(STAGE_COMMAND, seconds)
+        if frame_time is not None:
+            self.observe(STAGE_END_TO_END, time.monotonic() - frame_time)
+
+    @property
+    def frame_rate(self) -> float | None:
+        """Frames per second achieved over the last RATE_WINDOW frames, 0 once the loop stopped."""
+        if len(self._frame_times) < 2:
+            return None
+        now = time.monotonic()
+        window = self._frame_times[-1] - self._frame_times[0]
+        if now - self._frame_times[-1] > max(window / (len(self._frame_times) - 1) * 5, 5):
+            return 0.0 # no frames for a while
+        return round((len(self._frame_times) - 1) / window, 2) if window > 0 else None
+
+
+def _sample(name, labels, value) -> str:
+    return name + '{' + ','.join(key + '="' + str(label) + '"' for key, label in labels) + '} ' + str(value)
+
+
+def render_metrics(metrics_by_host: dict[str, Metrics]) -> str:
+    """Render the metrics of all tv's in the Prometheus text exposition format."""
+    lines = []
+
+    def family(name, kind, description, samples):
+        lines.append('# HELP ' + name + ' ' + description)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        lines.extend(samples)
+
+    hosts = sorted(metrics_by_host.items())
+    family('ambilight_frames_total', 'counter', 'Ambilight frames fetched and sent to the listeners.',
+           [_sample('ambilight_frames_total', [('host', host)], metrics.frames) for host, metrics in hosts])
+    family('ambilight_skipped_frames_total', 'counter', 'Frames skipped because the loop fell behind.',
+           [_sample('ambilight_skipped_frames_total', [('host', host)], metrics.skipped_frames) for host, metrics in hosts])
+    family('ambilight_suppressed_updates_total', 'counter', 'Light updates suppressed by the change threshold.',
+           [_sample('ambilight_suppressed_updates_total', [('host', host)], metrics.suppressed_updates) for host, metrics in hosts])
+    family('ambilight_frame_rate', 'gauge', 'Achieved frames per second.',
+           [_sample('ambilight_frame_rate', [('host', host)], metrics.frame_rate) for host, metrics in hosts if metrics.frame_rate is not None])
+    family('ambilight_device_commands_total', 'counter', 'Commands sent per output device.',
+           [_sample('ambilight_device_commands_total', [('host', host), ('device', device)], count)
+            for host, metrics in hosts for device, count in sorted(metrics.device_commands.items())])
+    family('ambilight_device_errors_total', 'counter', 'Failed commands per output device.',
+           [_sample('ambilight_device_errors_total', [('host', host), ('device', device)], metrics.device_errors.get(device, 0))
+            for host, metrics in hosts for device in sorted(metrics.device_commands)])
+    samples = []
+    for host, metrics in hosts:
+        for stage, histogram in metrics.histograms.items():
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                samples.append(_sample('ambilight_stage_seconds_bucket', [('host', host), ('stage', stage), ('le', bucket)], cumulative))
+            samples.append(_sample('ambilight_stage_seconds_sum', [('host', host), ('stage', stage)], histogram.sum))
+            samples.append(_sample('ambilight_stage_seconds_count', [('host', host), ('stage', stage)], histogram.count))
+    family('ambilight_stage_seconds', 'histogram', 'Latency of each stage of a frame.', samples)
+    return '\n'.join(lines) + '\n'
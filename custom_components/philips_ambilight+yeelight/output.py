@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import math
+from itertools import chain
+
+DEFAULT_GAMMA = 1.0 # no correction
+DEFAULT_WHITE_BALANCE = [1.0, 1.0, 1.0] # gains of the red, green and blue channel
+
+# weighted squares of a channel, their sum indexes _ROOTS (perceived brightness, see http://alienryderflex.com/hsp.html)
+_RED_SQUARES = tuple(c * c * .241 for c in range(256))
+_GREEN_SQUARES = tuple(c * c * .691 for c in range(256))
+_BLUE_SQUARES = tuple(c * c * .068 for c in range(256))
+_ROOTS = tuple(math.isqrt(s) for s in range(255 * 255 + 1))
+
+
+def luminance(r, g, b) -> int:
+    """Perceived brightness (0-255) of a colour."""
+    return _ROOTS[int(_RED_SQUARES[int(r)] + _GREEN_SQUARES[int(g)] + _BLUE_SQUARES[int(b)])]
+
+
+def _channel_table(gamma, gain) -> tuple:
+    return tuple(min(255, int(255 * (c / 255) ** gamma * gain + 0.5)) for c in range(256))
+
+
+class ColorPipeline:
+    """Turns the region colour into what is sent to the lights of one light block.
+
+    Everything is precomputed into lookup tables when the switch is set up: the brightness curve
+    (0-254, with min_brightness and max_brightness in percent baked in) and per channel the gamma
+    and white balance calibration of the lights, so a frame only costs a few table indexes.
+    """
+
+    def __init__(self, min_brightness=1, max_brightness=100, gamma=DEFAULT_GAMMA, white_balance=DEFAULT_WHITE_BALANCE) -> None:
+        self.min_brightness = int(min_brightness / 100 * 254)
+        max_value = int(max_brightness / 100 * 254)
+        curve = []
+        for value in range(256):
+            brightness = max(value, 1, self.min_brightness) # a black picture still gives the lowest brightness
+            if max_brightness < 100:
+                brightness = brightness / 100 * max_brightness
+            curve.append(int(min(brightness, max_value)))
+        self._curve = tuple(curve)
+        self._red, self._green, self._blue = (_channel_table(gamma, gain) for gain in white_balance)
+        self._red_bytes, self._green_bytes, self._blue_bytes = bytes(self._red), bytes(self._green), bytes(self._blue)
+
+    def brightness(self, value) -> int:
+        """Brightness to send for a luminance (see luminance())."""
+        return self._curve[value]
+
+    def color(self, r, g, b) -> tuple:
+        """Calibrated colour to send for a region colour."""
+        return self._red[int(r)], self._green[int(g)], self._blue[int(b)]
+
+    def pixels(self, colors) -> bytearray:
+        """Calibrated r, g, b bytes of a list of colours (e.g. the segments of a strip), translated per channel in one go."""
+        raw = bytes(chain.from_iterable(colors))
+        data = bytearray(len(raw))
+        data[0::3] = raw[0::3].translate(self._red_bytes)
+        data[1::3] = raw[1::3].translate(self._green_bytes)
+        data[2::3] = raw[2::3].translate(self._blue_bytes)
+        return data
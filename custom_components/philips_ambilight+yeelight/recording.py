@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import json
+import logging
+import struct
+import time
+from array import array
+from typing import TYPE_CHECKING
+
+from .decode import SIDES
+
+if TYPE_CHECKING: # the reader also works without home assistant, e.g. in the benchmarks
+    from homeassistant.core import HomeAssistant
+
+_LOGGER = logging.getLogger(__name__)
+
+# file   := MAGIC record*
+# record := kind (uint8), wall clock timestamp (float64), payload length (uint32), payload
+# frame payload  := per side: side (uint8 index in SIDES), pixel count (uint16), r, g, b bytes per pixel
+# config payload := the ambilight_current_configuration as JSON, written whenever it changes
+MAGIC = b'AMBIREC1'
+RECORD_HEADER = struct.Struct('<BdI')
+SIDE_HEADER = struct.Struct('<BH')
+KIND_FRAME = 1
+KIND_CONFIG = 2
+FLUSH_INTERVAL = 1.0 # seconds frames are buffered in memory before they are appended to the file
+FLUSH_SIZE = 65536 # bytes after which the buffer is appended anyway
+MAX_REPLAY_GAP = 1.0 # seconds, longer pauses between frames (e.g. between two sessions appended to a file) are replayed as this
+
+
+def pack_frame(frame) -> bytes:
+    """Serialize a compact frame (side -> [r, g, b, ...], see decode.py)."""
+    payload = bytearray()
+    for index, side in enumerate(SIDES):
+        if side in frame:
+            pixels = frame[side]
+            payload += SIDE_HEADER.pack(index, len(pixels) // 3)
+            payload += bytes(pixels)
+    return bytes(payload)
+
+
+def unpack_frame(payload) -> dict[str, array]:
+    frame = {}
+    offset = 0
+    while offset < len(payload):
+        index, count = SIDE_HEADER.unpack_from(payload, offset)
+        offset += SIDE_HEADER.size
+        frame[SIDES[index]] = array('B', payload[offset:offset + count * 3])
+        offset += count * 3
+    return frame
+
+
+def read_recording(path):
+    """Yield (timestamp, configuration, frame) for every frame of a recording.
+
+    A record cut off at the end (e.g. Home Assistant stopped while writing) ends the recording.
+    """
+    with open(path, 'rb') as recording:
+        data = recording.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(path + ' is not an ambilight recording')
+    offset = len(MAGIC)
+    configuration = None
+    while offset + RECORD_HEADER.size <= len(data):
+        kind, timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            break
+        payload = data[offset:offset + length]
+        offset += length
+        if kind == KIND_CONFIG:
+            configuration = json.loads(payload)
+        elif kind == KIND_FRAME:
+            yield timestamp, configuration, unpack_frame(payload)
+
+
+def frame_offsets(frames, max_gap=MAX_REPLAY_GAP) -> list[float]:
+    """Seconds from the first frame to every frame of read_recording(), with every pause capped at max_gap.
+
+    Timestamps are wall clock and recordings are appended to, so without the cap a replay would sit
+    idle for the hours between two sessions (and a clock change could even turn a pause negative).
+    """
+    offsets = []
+    offset = 0.0
+    previous = frames[0][0] if frames else 0.0
+    for timestamp, configuration, frame in frames:
+        offset += min(max(timestamp - previous, 0.0), max_gap)
+        previous = timestamp
+        offsets.append(offset)
+    return offsets
+
+
+class FrameRecorder:
+    """Appends the fetched frames and the tv's ambilight configuration to a recording.
+
+    Records are buffered in memory and appended from the executor, at most one write at a time so
+    the records stay in order, which keeps file I/O out of the event loop.
+    """
+
+    def __init__(self, hass: HomeAssistant, path) -> None:
+        self._hass = hass
+        self._path = path
+        self._buffer = bytearray()
+        self._configuration = None
+        self._last_flush = time.monotonic()
+        self._writing = None
+        self._chained = False # a flush is waiting for the running write
+
+    def record(self, frame, configuration) -> None:
+        timestamp = time.time()
+        if configuration != self._configuration:
+            self._configuration = configuration
+            payload = json.dumps(configuration).encode()
+            self._buffer += RECORD_HEADER.pack(KIND_CONFIG, timestamp, len(payload)) + payload
+        payload = pack_frame(frame)
+        self._buffer += RECORD_HEADER.pack(KIND_FRAME, timestamp, len(payload)) + payload
+        if len(self._buffer) >= FLUSH_SIZE or time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        if self._writing is not None and not self._writing.done():
+            if not self._chained: # appends the rest as soon as the running write is done
+                self._chained = True
+                self._writing.add_done_callback(self._flush_after_write)
+            return
+        data, self._buffer = bytes(self._buffer), bytearray()
+        self._last_flush = time.monotonic()
+        self._writing = self._hass.async_add_executor_job(self._append, data)
+
+    def _flush_after_write(self, _future) -> None:
+        self._chained = False
+        self.flush()
+
+    async def async_close(self) -> None:
+        """Append everything that is still buffered and wait until it is written."""
+        while self._buffer or (self._writing is not None and not self._writing.done()):
+            if self._writing is not None and not self._writing.done():
+                await self._writing
+            else:
+                self.flush()
+
+    def _append(self, data):
+        try:
+            with open(self._path, 'ab') as recording:
+                if recording.tell() == 0:
+                    recording.write(MAGIC)
+                recording.write(data)
+        except OSError as e:
+            _LOGGER.error('Failed to write the ambilight recording ' + self._path + ': ' + str(e))
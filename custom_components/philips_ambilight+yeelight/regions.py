@@ -0,0 +1,428 @@
+from __future__ import annotations
+
+import logging
+import math
+from operator import sub
+from collections.abc import Callable, Iterable
+from typing import NamedTuple
+
+try:
+    import numpy as np
+except ImportError: # numpy is optional, only the vectorized extractor needs it
+    np = None
+
+_LOGGER = logging.getLogger(__name__)
+
+SIDES = ('left', 'top', 'right', 'bottom')
+
+# pixel selectors, resolved against the number of pixels on a side when a region is compiled
+# for tv topology see http://jointspace.sourceforge.net/projectdata/documentation/jasonApi/1/doc/API-Method-ambilight-topology-GET.html
+FIRST = 'first'
+LAST = 'last'
+MIDDLE = 'middle'
+BEFORE_MIDDLE = 'before-middle'
+ALL = 'all'
+
+SINGLE = 'single' # the colour of one pixel
+RMS = 'rms' # root mean square of the selected pixels
+
+# 'display_options' value given in home assistant -> (selected pixels, reduction)
+REGIONS = {
+    'top-middle-average': ((('top', BEFORE_MIDDLE), ('top', MIDDLE)), RMS),
+    'top-average': ((('top', ALL),), RMS),
+    'right-average': ((('right', ALL),), RMS),
+    'left-average': ((('left', ALL),), RMS),
+    'bottom-average': ((('bottom', ALL),), RMS),
+    'top-middle': ((('top', MIDDLE),), SINGLE),
+    'top-center': ((('top', MIDDLE),), SINGLE),
+    'top': ((('top', MIDDLE),), SINGLE),
+    'bottom-middle': ((('bottom', MIDDLE),), SINGLE),
+    'bottom-center': ((('bottom', MIDDLE),), SINGLE),
+    'bottom': ((('bottom', MIDDLE),), SINGLE),
+    'right': ((('right', MIDDLE),), SINGLE),
+    'left': ((('left', MIDDLE),), SINGLE),
+    'top-right-average': ((('right', FIRST), ('top', LAST)), RMS),
+    'top-left-average': ((('left', LAST), ('top', FIRST)), RMS),
+    'bottom-right-average': ((('right', LAST), ('bottom', LAST)), RMS),
+    'bottom-left-average': ((('left', FIRST), ('bottom', FIRST)), RMS),
+    'right-top': ((('right', FIRST),), SINGLE),
+    'left-top': ((('left', LAST),), SINGLE),
+    'top-left': ((('top', FIRST),), SINGLE),
+    'top-right': ((('top', LAST),), SINGLE),
+    'right-bottom': ((('right', LAST),), SINGLE),
+    'left-bottom': ((('left', FIRST),), SINGLE),
+    'bottom-left': ((('bottom', FIRST),), SINGLE),
+    'bottom-right': ((('bottom', LAST),), SINGLE),
+}
+
+NO_COLOR = (None, None, None)
+
+# sides whose pixel indexes run counter-clockwise around the screen (seen from the front), so strips read them backwards
+REVERSED_SIDES = ('bottom',)
+
+
+class Strip(NamedTuple):
+    """Region of a segmented light strip: the pixels of the sides, clockwise, resampled to a number of segments.
+
+    A strip reduces to one (r, g, b) per segment instead of a single colour.
+    """
+
+    sides: tuple
+    segments: int
+    reverse: bool = False
+
+
+def get_topology(layer1, sides=SIDES) -> tuple:
+    """Return the (side, number of pixels) pairs of an ambilight layer, limited to the given sides."""
+    return tuple((side, len(layer1[side])) for side in SIDES if side in sides and side in layer1)
+
+
+def _resolve(selector, count) -> range:
+    if selector == ALL:
+        return range(count)
+    if selector == FIRST:
+        return range(0, 1)
+    if selector == LAST:
+        return range(count - 1, count)
+    if selector == MIDDLE:
+        return range(count // 2, count // 2 + 1)
+    if selector == BEFORE_MIDDLE: # the only pixel of a side with one pixel, not the last one of the previous side
+        return range(max(count // 2 - 1, 0), max(count // 2, 1))
+    raise ValueError('Unknown pixel selector ' + str(selector))
+
+
+def strip_pixels(strip: Strip, topology) -> tuple | None:
+    """Return the (side, pixel index) pairs along a strip, or None if the tv can't provide them."""
+    counts = dict(topology)
+    pixels = []
+    for side in strip.sides:
+        if not counts.get(side):
+            return None
+        indexes = range(counts[side])
+        pixels.extend((side, index) for index in (reversed(indexes) if side in REVERSED_SIDES else indexes))
+    if strip.reverse:
+        pixels.reverse()
+    return tuple(pixels)
+
+
+def resample(count, segments) -> list[list[tuple]]:
+    """Return the (pixel, weight) pairs of every segment when spreading count pixels over segments.
+
+    A segment averages the pixels it covers (weighted by how much of each it covers) when there are
+    fewer segments than pixels, and interpolates between the two nearest pixels when there are more.
+    """
+    scale = count / segments
+    rows = []
+    for segment in range(segments):
+        if scale >= 1:
+            start, end = segment * scale, (segment + 1) * scale
+            taps = []
+            for index in range(int(start), min(count, math.ceil(end))):
+                overlap = min(end, index + 1) - max(start, index)
+                if overlap > 0:
+                    taps.append((index, overlap / scale))
+        else:
+            position = min(max((segment + 0.5) * scale - 0.5, 0), count - 1)
+            index = int(position)
+            fraction = position - index
+            taps = [(index, 1 - fraction)]
+            if fraction:
+                taps.append((index + 1, fraction))
+        rows.append(taps)
+    return rows
+
+
+def region_weights(position, topology) -> list[list[tuple]] | None:
+    """Return per output colour the (side, pixel index, weight) triples it averages, or None if the tv can't provide them."""
+    if isinstance(position, Strip):
+        pixels = strip_pixels(position, topology)
+        if pixels is None:
+            return None
+        return [[pixels[index] + (weight,) for index, weight in taps] for taps in resample(len(pixels), position.segments)]
+    pixels = region_pixels(position, topology)
+    if pixels is None:
+        return None
+    return [[(side, index, 1 / len(pixels)) for side, index in pixels]]
+
+
+def region_pixels(position, topology) -> tuple | None:
+    """Return the (side, pixel index) pairs a region reads, or None if the tv can't provide them."""
+    if isinstance(position, Strip):
+        return strip_pixels(position, topology)
+    if position not in REGIONS:
+        return None
+    counts = dict(topology)
+    pixels = []
+    for side, selector in REGIONS[position][0]:
+        if not counts.get(side):
+            return None
+        pixels.extend((side, index) for index in _resolve(selector, counts[side]))
+    return tuple(pixels)
+
+
+def compile_region(position, topology) -> Callable | None:
+    """Compile a region into a function reducing a frame to a single (r, g, b).
+
+    A frame maps each side to a flat [r, g, b, r, g, b, ...] list, see RegionExtractor.
+    Returns None when the region is unknown or the tv lacks one of the sides it uses.
+    """
+    if isinstance(position, Strip):
+        return compile_strip(position, topology)
+    pixels = region_pixels(position, topology)
+    if pixels is None:
+        return None
+    counts = dict(topology)
+    selection, reduction = REGIONS[position]
+    picks = tuple((side, index * 3) for side, index in pixels)
+
+    if reduction == SINGLE:
+        side, offset = picks[0]
+
+        def extract_single(frame):
+            pixels = frame[side]
+            return pixels[offset], pixels[offset + 1], pixels[offset + 2]
+        return extract_single
+
+    if len(selection) == 1 and selection[0][1] == ALL:
+        side, count = selection[0][0], counts[selection[0][0]]
+
+        def extract_side(frame):
+            pixels = frame[side]
+            r_sum = g_sum = b_sum = 0
+            for offset in range(0, count * 3, 3):
+                r, g, b = pixels[offset], pixels[offset + 1], pixels[offset + 2]
+                r_sum += r * r
+                g_sum += g * g
+                b_sum += b * b
+            return int(math.sqrt(r_sum / count)), int(math.sqrt(g_sum / count)), int(math.sqrt(b_sum / count))
+        return extract_side
+
+    count = len(picks)
+
+    def extract_pixels(frame):
+        r_sum = g_sum = b_sum = 0
+        for side, offset in picks:
+            pixels = frame[side]
+            r, g, b = pixels[offset], pixels[offset + 1], pixels[offset + 2]
+            r_sum += r * r
+            g_sum += g * g
+            b_sum += b * b
+        return int(math.sqrt(r_sum / count)), int(math.sqrt(g_sum / count)), int(math.sqrt(b_sum / count))
+    return extract_pixels
+
+
+def compile_strip(strip: Strip, topology) -> Callable | None:
+    """Compile a strip into a function reducing a frame to a list of (r, g, b), one per segment."""
+    weights = region_weights(strip, topology)
+    if weights is None:
+        return None
+    rows = tuple(tuple((side, index * 3, weight) for side, index, weight in taps) for taps in weights)
+
+    def extract_strip(frame):
+        colors = []
+        for taps in rows:
+            r_sum = g_sum = b_sum = 0.0
+            for side, offset, weight in taps:
+                pixels = frame[side]
+                r, g, b = pixels[offset], pixels[offset + 1], pixels[offset + 2]
+                r_sum += weight * r * r
+                g_sum += weight * g * g
+                b_sum += weight * b * b
+            colors.append((int(math.sqrt(r_sum)), int(math.sqrt(g_sum)), int(math.sqrt(b_sum))))
+        return colors
+    return extract_strip
+
+
+def region_sides(position) -> set:
+    """Return the sides a region reads from."""
+    if isinstance(position, Strip):
+        return set(position.sides)
+    if position not in REGIONS:
+        return set()
+    return {side for side, selector in REGIONS[position][0]}
+
+
+class RegionExtractor:
+    """Reduces ambilight layers to the colours of a set of regions.
+
+    The regions are compiled against the tv's topology once, and recompiled only when the
+    topology (the sides and their number of pixels) changes, so a frame costs one pass over
+    the pixels of the sides in use plus a tight reduction per region.
+    """
+
+    def __init__(self) -> None:
+        self._positions: tuple = ()
+        self._sides: frozenset = frozenset()
+        self._topology = None
+        self._extractors: dict[str, Callable | None] = {}
+        self._keys: dict[str, list[str]] = {}
+        self._frame: dict[str, list[int]] = {}
+        self._previous: dict[str, list[int]] = {}
+        self.delta: int | None = None # largest change of a colour channel since the previous frame, None after a topology change
+
+    @property
+    def topology(self):
+        return self._topology
+
+    @property
+    def sides(self) -> frozenset:
+        """The sides read by the regions in use."""
+        return self._sides
+
+    def set_regions(self, positions: Iterable[str]) -> None:
+        positions = tuple(sorted(set(positions), key=str)) # ambi_region names and strips
+        if positions == self._positions:
+            return
+        self._positions = positions
+        self._sides = frozenset(side for position in positions for side in region_sides(position))
+        if self._topology is not None:
+            self._compile(self._topology)
+
+    def _compile(self, topology) -> None:
+        _LOGGER.debug('Compiling ambilight regions for topology ' + str(topology))
+        self._topology = topology
+        counts = dict(topology)
+        self._extractors = {}
+        sides = set()
+        for position in self._positions:
+            extractor = compile_region(position, topology)
+            if extractor is None:
+                _LOGGER.error('The ambi_region ' + str(position) + ' is unknown or not supported by the topology of this TV.')
+            else:
+                sides |= region_sides(position)
+            self._extractors[position] = extractor
+        self._keys = {side: [str(i) for i in range(counts[side])] for side in sides}
+        self._frame = {side: [0] * (counts[side] * 3) for side in sides}
+        self._previous = {}
+
+    def _load(self, layer1) -> dict[str, list[int]]:
+        # copies the nested {'0': {'r':..,'g':..,'b':..}} dicts of the used sides into flat, reused buffers
+        for side, keys in self._keys.items():
+            pixels = layer1[side]
+            buffer = self._frame[side]
+            offset = 0
+            for key in keys:
+                pixel = pixels[key]
+                buffer[offset] = pixel['r']
+                buffer[offset + 1] = pixel['g']
+                buffer[offset + 2] = pixel['b']
+                offset += 3
+        return self._frame
+
+    def _load_frame(self, frame):
+        # compact frames already have the layout the compiled regions read
+        return frame
+
+    def extract(self, layer1) -> dict[str, tuple]:
+        if layer1 is None:
+            return {position: NO_COLOR for position in self._positions}
+        topology = get_topology(layer1, self._sides) # sides nobody uses (or that weren't fetched) don't matter
+        if topology != self._topology:
+            self._compile(topology)
+        return self._reduce(self._load(layer1))
+
+    def extract_frame(self, frame) -> dict[str, tuple]:
+        """Like extract, for a compact frame (side -> flat [r, g, b, ...] array, see decode.py), without copying the pixels."""
+        if frame is None:
+            return {position: NO_COLOR for position in self._positions}
+        topology = tuple((side, len(frame[side]) // 3) for side in SIDES if side in self._sides and side in frame)
+        if topology != self._topology:
+            self._compile(topology)
+        return self._reduce(self._load_frame(frame))
+
+    def _reduce(self, frame) -> dict[str, tuple]:
+        self._measure(frame)
+        return {
+            position: NO_COLOR if extractor is None else extractor(frame)
+            for position, extractor in self._extractors.items()
+        }
+
+    def _measure(self, frame) -> None:
+        if not self._previous:
+            self.delta = None
+            self._previous = {side: list(frame[side]) for side in self._frame}
+            return
+        delta = 0
+        for side, previous in self._previous.items():
+            pixels = frame[side]
+            if pixels:
+                delta = max(delta, max(map(abs, map(sub, pixels, previous))))
+            previous[:] = pixels
+        self.delta = delta
+
+
+class VectorRegionExtractor(RegionExtractor):
+    """RegionExtractor running every reduction as one vectorized operation (requires numpy).
+
+    The used sides are stacked into a single (n_pixels, 3) array per frame, and all regions are
+    reduced at once by multiplying the squared pixels with a (n_regions, n_pixels) matrix of
+    averaging weights, so adding regions or pixels costs no extra Python-level work.
+    """
+
+    def __init__(self) -> None:
+        if np is None:
+            raise ImportError('numpy is required for the vectorized region extractor')
+        super().__init__()
+        self._offsets: dict[str, int] = {}
+        self._rows: dict[str, slice] = {}
+        self._weights = None
+        self._pixels = None
+
+    def _compile(self, topology) -> None:
+        super()._compile(topology)
+        counts = dict(topology)
+        self._offsets = {}
+        total = 0
+        for side in SIDES:
+            if side in self._keys:
+                self._offsets[side] = total
+                total += counts[side]
+        self._rows = {} # position -> its rows in the weight matrix, a strip has one per segment
+        weights = []
+        for position, extractor in self._extractors.items():
+            if extractor is not None:
+                rows = region_weights(position, topology)
+                self._rows[position] = slice(len(weights), len(weights) + len(rows))
+                weights.extend(rows)
+        self._weights = np.zeros((len(weights), total))
+        for row, taps in enumerate(weights):
+            for side, index, weight in taps:
+                self._weights[row, self._offsets[side] + index] += weight
+        self._pixels = np.zeros((total, 3))
+        self._previous = None
+
+    def _load(self, layer1):
+        for side, keys in self._keys.items():
+            pixels = layer1[side]
+            offset = self._offsets[side]
+            self._pixels[offset:offset + len(keys)] = np.fromiter(
+                (pixels[key][channel] for key in keys for channel in 'rgb'), dtype=np.float64, count=len(keys) * 3
+            ).reshape(-1, 3)
+        return self._pixels
+
+    def _load_frame(self, frame):
+        for side in self._keys:
+            offset = self._offsets[side]
+            pixels = np.asarray(frame[side]).reshape(-1, 3)
+            self._pixels[offset:offset + len(pixels)] = pixels
+        return self._pixels
+
+    def _reduce(self, pixels) -> dict[str, tuple]:
+        self._measure(pixels)
+        np.multiply(pixels, pixels, out=pixels)
+        colors = dict.fromkeys(self._extractors, NO_COLOR)
+        results = np.sqrt(self._weights @ pixels).astype(int).tolist()
+        for position, rows in self._rows.items():
+            if isinstance(position, Strip):
+                colors[position] = [tuple(color) for color in results[rows]]
+            else:
+                colors[position] = tuple(results[rows.start])
+        return colors
+
+    def _measure(self, pixels) -> None:
+        if self._previous is None:
+            self.delta = None
+            self._previous = pixels.copy()
+            return
+        self.delta = int(np.abs(pixels - self._previous).max()) if len(pixels) else 0
+        self._previous[...] = pixels
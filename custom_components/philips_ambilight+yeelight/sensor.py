@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import logging
+from abc import ABC, abstractmethod
+from datetime import timedelta
+
+import voluptuous as vol
+from aiohttp import web
+
+import homeassistant.helpers.config_validation as cv
+
+from homeassistant.components.http import HomeAssistantView
+from homeassistant.components.sensor import (
+    PLATFORM_SCHEMA,
+    SensorEntity,
+    SensorStateClass)
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.typing import DiscoveryInfoType
+
+from .metrics import STAGES, Metrics, render_metrics
+from .switch import CONF_TV_ADDRESS, DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+SCAN_INTERVAL = timedelta(seconds=10)
+
+CONF_NAME, DEFAULT_NAME = "name", "Ambilight"
+CONF_METRICS_ENDPOINT, DEFAULT_METRICS_ENDPOINT = "metrics_endpoint", False
+
+PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
+    {
+        vol.Required(CONF_TV_ADDRESS): cv.string,
+        vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+        vol.Optional(CONF_METRICS_ENDPOINT, default=DEFAULT_METRICS_ENDPOINT): cv.boolean,
+    }
+)
+
+async def async_setup_platform(
+            hass: HomeAssistant,
+            config,
+            async_add_entities: AddEntitiesCallback,
+            discovery_info: DiscoveryInfoType | None = None
+        ) -> None:
+    tvip = config.get(CONF_TV_ADDRESS)
+    name = config.get(CONF_NAME)
+    if config.get(CONF_METRICS_ENDPOINT):
+        async_register_metrics_view(hass)
+
+    dev: list[SensorEntity] = [
+        AmbilightFrameRateSensor(hass, tvip, name),
+        AmbilightCounterSensor(hass, tvip, name, 'skipped frames', 'skipped_frames'),
+        AmbilightCounterSensor(hass, tvip, name, 'suppressed updates', 'suppressed_updates'),
+        AmbilightErrorSensor(hass, tvip, name),
+    ]
+    dev.extend(AmbilightLatencySensor(hass, tvip, name, stage) for stage in STAGES)
+    async_add_entities(dev, True)
+
+def get_metrics(hass: HomeAssistant, tvip) -> Metrics | None:
+    # the coordinator only exists while switches of this tv are set up, see switch.async_get_tv_coordinator
+    coordinator = hass.data.get(DOMAIN, {}).get('coordinators', {}).get(tvip)
+    return None if coordinator is None else coordinator.metrics
+
+@callback
+def async_register_metrics_view(hass: HomeAssistant):
+    data = hass.data.setdefault(DOMAIN, {})
+    if not data.get('metrics_view'):
+        hass.http.register_view(AmbilightMetricsView())
+        data['metrics_view'] = True
+
+class AmbilightMetricsView(HomeAssistantView):
+    """The metrics of all tv's in the Prometheus text format."""
+
+    url = '/api/philips_ambilight_yeelight/metrics'
+    name = 'api:philips_ambilight_yeelight:metrics'
+    requires_auth = True
+
+    async def get(self, request: web.Request) -> web.Response:
+        hass: HomeAssistant = request.app['hass']
+        coordinators = hass.data.get(DOMAIN, {}).get('coordinators', {})
+        body = render_metrics({tvip: coordinator.metrics for tvip, coordinator in coordinators.items()})
+        return web.Response(body=body.encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+class AmbilightMetricSensor(SensorEntity, ABC):
+    """A metric of one tv, read from its coordinator on every update."""
+
+    _attr_icon = 'mdi:chart-line'
+
+    def __init__(self, hass: HomeAssistant, tvip, name, metric_name) -> None:
+        self._hass = hass
+        self._tvip = tvip
+        self._attr_name = name + ' ' + metric_name
+        self._attr_unique_id = DOMAIN + '_' + tvip + '_' + metric_name.replace(' ', '_')
+        self._attr_available = False
+
+    async def async_update(self) -> None:
+        metrics = get_metrics(self._hass, self._tvip)
+        self._attr_available = metrics is not None
+        if metrics is not None:
+            self.update_from(metrics)
+
+    @abstractmethod
+    def update_from(self, metrics: Metrics) -> None:
+        """Set the state (and attributes) of the sensor from the tv's metrics."""
+
+class AmbilightFrameRateSensor(AmbilightMetricSensor):
+
+    _attr_native_unit_of_measurement = 'fps'
+    _attr_state_class = SensorStateClass.MEASUREMENT
+
+    def __init__(self, hass: HomeAssistant, tvip, name) -> None:
+        super().__init__(hass, tvip, name, 'frame rate')
+
+    def update_from(self, metrics: Metrics) -> None:
+        self._attr_native_value = metrics.frame_rate
+        self._attr_extra_state_attributes = {'frames': metrics.frames}
+
+class AmbilightCounterSensor(AmbilightMetricSensor):
+
+    _attr_state_class = SensorStateClass.TOTAL_INCREASING
+
+    def __init__(self, hass: HomeAssistant, tvip, name, metric_name, attribute) -> None:
+        super().__init__(hass, tvip, name, metric_name)
+        self._attribute = attribute
+
+    def update_from(self, metrics: Metrics) -> None:
+        self._attr_native_value = getattr(metrics, self._attribute)
+
+class AmbilightErrorSensor(AmbilightMetricSensor):
+    """Failed commands of all output devices, per device in the attributes."""
+
+    _attr_state_class = SensorStateClass.TOTAL_INCREASING
+
+    def __init__(self, hass: HomeAssistant, tvip, name) -> None:
+        super().__init__(hass, tvip, name, 'device errors')
+
+    def update_from(self, metrics: Metrics) -> None:
+        self._attr_native_value = sum(metrics.device_errors.values())
+        self._attr_extra_state_attributes = {
+            device: {'commands': count, 'errors': metrics.device_errors.get(device, 0)}
+            for device, count in metrics.device_commands.items()
+        }
+
+class AmbilightLatencySensor(AmbilightMetricSensor):
+    """Median latency of a stage over the recent frames, with the tail in the attributes."""
+
+    _attr_native_unit_of_measurement = 'ms'
+    _attr_state_class = SensorStateClass.MEASUREMENT
+
+    def __init__(self, hass: HomeAssistant, tvip, name, stage) -> None:
+        super().__init__(hass, tvip, name, stage.replace('_', ' ') + ' latency')
+        self._stage = stage
+
+    def update_from(self, metrics: Metrics) -> None:
+        histogram = metrics.histograms[self._stage]
+        self._attr_native_value = _ms(histogram.percentile(50))
+        self._attr_extra_state_attributes = {
+            'p95': _ms(histogram.percentile(95)),
+            'p99': _ms(histogram.percentile(99)),
+            'max': _ms(histogram.percentile(100)),
+            'count': histogram.count,
+        }
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
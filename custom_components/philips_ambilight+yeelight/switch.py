@@ -2,7 +2,10 @@ from __future__ import annotations
 
 import asyncio
 import logging
-from itertools import repeat
+import time
+from functools import partial
+from itertools import chain, repeat
+from typing import Any
 
 import voluptuous as vol
 
@@ -23,6 +26,7 @@ from homeassistant.components.light import VALID_TRANSITION, is_on
 
 from homeassistant.const import (
     CONF_LIGHTS,
+    EVENT_HOMEASSISTANT_STOP,
     SERVICE_TURN_ON,
     SERVICE_TURN_OFF,
     STATE_ON,
@@ -33,23 +37,29 @@ from homeassistant.core import HomeAssistant, ServiceCall, callback
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 
-from requests.auth import HTTPDigestAuth
-from requests.adapters import HTTPAdapter
-
-from haphilipsjs import PhilipsTV
-
 from collections.abc import Callable
 
 import string
-from yeelight import *
 # from datetime import timedelta
 
-import math
+from .dispatch import LightDispatcher, RateLimiter
+from .decode import flatten_layer
+from .jointspace import TIMEOUT, JointSpaceClient
+from .metrics import STAGE_DECODE, STAGE_EXTRACT, STAGE_FANOUT, STAGE_FETCH, Metrics
+from .output import DEFAULT_GAMMA, DEFAULT_WHITE_BALANCE, ColorPipeline, luminance
+from .filters import DEFAULT_CHANGE_THRESHOLD, DEFAULT_MAX_STALENESS, FILTERS, ChangeGate, make_filter
+from .recording import FrameRecorder, frame_offsets, read_recording
+from .regions import NO_COLOR, SIDES, RegionExtractor, Strip, VectorRegionExtractor
+from .udp import DDP, E131, UdpOutput
+from .wled import WledClient, encode_leds
+from .yeelight_async import DEFAULT_STATE_TTL, AsyncBulb, MusicServer, encode_color_flow
 
 _LOGGER = logging.getLogger(__name__)
 
 # MIN_TIME_BETWEEN_UPDATES = timedelta(minutes=1)
 
+DOMAIN = "philips_ambilight+yeelight"
+
 CONF_TV_ADDRESS, DEFAULT_TV_ADDRESS = "tv_address", "127.0.0.1"
 CONF_API_VERSION, DEFAULT_API_VERSION = "api_version", 6
 CONF_USERNAME, DEFAULT_USER = "username", "user"
@@ -58,14 +68,41 @@ CONF_NAME, DEFAULT_NAME = "name", "Ambilights+Yeelight"
 CONF_AMBI_REGION, DEFAULT_AMBI_REGION = "ambi_region", "top"
 CONF_LIGHTS_RGB = "lights_rgb"
 CONF_LIGHTS_CT = "lights_ct"
+CONF_WLED = "wled"
+CONF_DDP = "ddp"
+CONF_E131 = "e131"
+CONF_UNIVERSE, DEFAULT_UNIVERSE = "universe", 1
+CONF_SEGMENTS = "segments"
+CONF_STRIP_SIDES, DEFAULT_STRIP_SIDES = "strip_sides", ['left', 'top', 'right']
+CONF_REVERSE, DEFAULT_REVERSE = "reverse", False
 CONF_YEELIGHTS, DEFAULT_YEELIGHTS = "yeelights", "127.0.0.1"
 CONF_ICON, DEFAULT_ICON = "icon", "mdi:television-ambient-light"
 CONF_MIN_BRIGHTNESS, DEFAULT_MIN_BRIGHTNESS = "min_brightness", 1
 CONF_MAX_BRIGHTNESS, DEFAULT_MAX_BRIGHTNESS = "max_brightness", 100
-
-BASE_URL = 'https://{0}:1926/6/{1}' # for older philps tv's, try changing this to 'http://{0}:1925/1/{1}'
-TIMEOUT = 5.0 # get/post request timeout with tv
-CONNFAILCOUNT = 5 # number of get/post attempts
+CONF_GAMMA = "gamma"
+CONF_WHITE_BALANCE = "white_balance"
+CONF_VECTORIZED, DEFAULT_VECTORIZED = "vectorized", False
+CONF_FAST_DECODE, DEFAULT_FAST_DECODE = "fast_decode", False
+CONF_RECORD_FILE = "record_file"
+CONF_REPLAY_FILE = "replay_file"
+CONF_REPLAY_SPEED, DEFAULT_REPLAY_SPEED = "replay_speed", 1.0
+CONF_STATE_TTL = "state_ttl"
+CONF_CHANGE_THRESHOLD = "change_threshold"
+CONF_MAX_STALENESS = "max_staleness"
+CONF_DIRECT_UPDATES, DEFAULT_DIRECT_UPDATES = "direct_updates", False
+CONF_FILTER = "filter"
+CONF_FILTER_TYPE = "type"
+CONF_FILTER_ALPHA, DEFAULT_FILTER_ALPHA = "alpha", 0.5
+CONF_FILTER_WINDOW, DEFAULT_FILTER_WINDOW = "window", 3
+CONF_FILTER_MIN_CUTOFF, DEFAULT_FILTER_MIN_CUTOFF = "min_cutoff", 1.0
+CONF_FILTER_BETA, DEFAULT_FILTER_BETA = "beta", 0.01
+CONF_FRAME_RATE, DEFAULT_FRAME_RATE = "frame_rate", 10
+CONF_MIN_FRAME_RATE = "min_frame_rate"
+CONF_TIMEOUT = "timeout"
+
+YEELIGHT_QUOTA_INTERVAL = 1.0 # seconds between commands to a yeelight outside music mode (quota of 60 per minute)
+SCENE_CHANGE_THRESHOLD = 8 # change of a colour channel (0-255) between frames that counts as a scene change
+ADAPTIVE_BACKOFF = 1.25 # factor the frame period grows by for every static frame when min_frame_rate is set
 DEFAULT_RGB_COLOR = [255,255,255] # default colour for bulb when dimmed in game mode (and incase of failure) 
 
 
@@ -73,16 +110,42 @@ DEFAULT_RGB_COLOR = [255,255,255] # default colour for bulb when dimmed in game
 # The following line tracks entity states
 # async_track_state_change(self.hass, list(entities), sensor_state_listener)
 
+FILTER_SCHEMA = vol.Schema(
+    {
+        vol.Required(CONF_FILTER_TYPE): vol.In(FILTERS),
+        vol.Optional(CONF_FILTER_ALPHA, default=DEFAULT_FILTER_ALPHA): vol.All(vol.Coerce(float), vol.Range(min=0.01, max=1)),
+        vol.Optional(CONF_FILTER_WINDOW, default=DEFAULT_FILTER_WINDOW): vol.All(vol.Coerce(int), vol.Range(min=1, max=15)),
+        vol.Optional(CONF_FILTER_MIN_CUTOFF, default=DEFAULT_FILTER_MIN_CUTOFF): cv.positive_float,
+        vol.Optional(CONF_FILTER_BETA, default=DEFAULT_FILTER_BETA): cv.positive_float,
+    }
+)
+
 RESOURCE_SCHEMA = vol.Any(
     {
         vol.Optional(CONF_YEELIGHTS): cv.string,
         vol.Optional(CONF_LIGHTS_RGB): cv.entity_ids,
         vol.Optional(CONF_LIGHTS_CT): cv.entity_ids,
+        vol.Optional(CONF_WLED): cv.string,
+        vol.Optional(CONF_DDP): cv.string,
+        vol.Optional(CONF_E131): cv.string,
+        vol.Optional(CONF_UNIVERSE, default=DEFAULT_UNIVERSE): vol.All(vol.Coerce(int), vol.Range(min=1, max=63999)),
+        vol.Optional(CONF_SEGMENTS): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_STRIP_SIDES, default=DEFAULT_STRIP_SIDES): vol.All(cv.ensure_list, [vol.In(SIDES)]),
+        vol.Optional(CONF_REVERSE, default=DEFAULT_REVERSE): cv.boolean,
         vol.Optional(CONF_AMBI_REGION, default=DEFAULT_AMBI_REGION): cv.string,
         vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
         vol.Optional(CONF_ICON, default=DEFAULT_ICON): cv.icon,
         vol.Optional(CONF_MIN_BRIGHTNESS, default=DEFAULT_MIN_BRIGHTNESS): cv.positive_int,
-        vol.Optional(CONF_MAX_BRIGHTNESS, default=DEFAULT_MAX_BRIGHTNESS): cv.positive_int
+        vol.Optional(CONF_MAX_BRIGHTNESS, default=DEFAULT_MAX_BRIGHTNESS): cv.positive_int,
+        vol.Optional(CONF_GAMMA, default=DEFAULT_GAMMA): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=5)),
+        vol.Optional(CONF_WHITE_BALANCE, default=DEFAULT_WHITE_BALANCE): vol.All(
+            [vol.All(vol.Coerce(float), vol.Range(min=0, max=1))], vol.Length(min=3, max=3)
+        ),
+        vol.Optional(CONF_STATE_TTL, default=DEFAULT_STATE_TTL): cv.positive_float,
+        vol.Optional(CONF_CHANGE_THRESHOLD, default=DEFAULT_CHANGE_THRESHOLD): cv.positive_float,
+        vol.Optional(CONF_MAX_STALENESS, default=DEFAULT_MAX_STALENESS): cv.positive_float,
+        vol.Optional(CONF_DIRECT_UPDATES, default=DEFAULT_DIRECT_UPDATES): cv.boolean,
+        vol.Optional(CONF_FILTER): FILTER_SCHEMA
     }
 )
 
@@ -93,6 +156,14 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_API_VERSION, default=DEFAULT_API_VERSION): cv.string,
         vol.Required(CONF_USERNAME, default=DEFAULT_USER): cv.string,
         vol.Required(CONF_PASSWORD, default=DEFAULT_PASS): cv.string,
+        vol.Optional(CONF_VECTORIZED, default=DEFAULT_VECTORIZED): cv.boolean,
+        vol.Optional(CONF_FAST_DECODE, default=DEFAULT_FAST_DECODE): cv.boolean,
+        vol.Optional(CONF_RECORD_FILE): cv.string,
+        vol.Optional(CONF_REPLAY_FILE): cv.isfile,
+        vol.Optional(CONF_REPLAY_SPEED, default=DEFAULT_REPLAY_SPEED): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_FRAME_RATE, default=DEFAULT_FRAME_RATE): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=50)),
+        vol.Optional(CONF_MIN_FRAME_RATE): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=50)),
+        vol.Optional(CONF_TIMEOUT, default=TIMEOUT): cv.positive_float,
         vol.Required(CONF_LIGHTS): vol.Schema({cv.string: RESOURCE_SCHEMA}),
         # vol.Required(CONF_LIGHTS): vol.Schema({cv.ensure_list: RESOURCE_SCHEMA}),
     }
@@ -110,8 +181,17 @@ async def async_setup_platform(
     password = config.get(CONF_PASSWORD)
     resources = config.get(CONF_LIGHTS)
     api_version = config.get(CONF_API_VERSION)
-
-    tv_coordinator = AmbiHue(hass, tvip, api_version, user, password)
+    vectorized = config.get(CONF_VECTORIZED)
+    frame_rate = config.get(CONF_FRAME_RATE)
+    min_frame_rate = config.get(CONF_MIN_FRAME_RATE)
+    timeout = config.get(CONF_TIMEOUT)
+    fast_decode = config.get(CONF_FAST_DECODE)
+    record_file = config.get(CONF_RECORD_FILE)
+    replay_file = config.get(CONF_REPLAY_FILE)
+    replay_speed = config.get(CONF_REPLAY_SPEED)
+
+    tv_coordinator = async_get_tv_coordinator(hass, tvip, api_version, user, password, vectorized, frame_rate, min_frame_rate, timeout, fast_decode, record_file, replay_file, replay_speed)
+    music_server = async_get_music_server(hass)
 
     dev: list[SwitchEntity] = []
     for entry, data in resources.items():
@@ -121,34 +201,94 @@ async def async_setup_platform(
         lights_yeelight_ips = data.get(CONF_YEELIGHTS)
         lights_rgb = data.get(CONF_LIGHTS_RGB, [])
         lights_ct = data.get(CONF_LIGHTS_CT, [])
+        wled_host = data.get(CONF_WLED)
+        segments = data.get(CONF_SEGMENTS)
+        strip_sides = data.get(CONF_STRIP_SIDES)
+        reverse = data.get(CONF_REVERSE)
+        universe = data.get(CONF_UNIVERSE)
+        direct_updates = data.get(CONF_DIRECT_UPDATES)
         min_brightness = data.get(CONF_MIN_BRIGHTNESS)
         max_brightness = data.get(CONF_MAX_BRIGHTNESS)
+        state_ttl = data.get(CONF_STATE_TTL)
+        change_threshold = data.get(CONF_CHANGE_THRESHOLD)
+        max_staleness = data.get(CONF_MAX_STALENESS)
+        filter_config = data.get(CONF_FILTER)
+        gamma = data.get(CONF_GAMMA)
+        white_balance = data.get(CONF_WHITE_BALANCE)
 
         if lights_yeelight_ips is not None:
             dev.append(
                 AmbiHueYeeSwitch(
-                    hass, tv_coordinator, name, lights_yeelight_ips, option, icon, min_brightness, max_brightness
+                    hass, tv_coordinator, music_server, name, lights_yeelight_ips, option, icon, min_brightness, max_brightness, change_threshold, max_staleness, make_filter(filter_config), state_ttl, gamma, white_balance
                 )
             )
 
         if lights_rgb is not None:
             dev.append(
                 AmbiHueRgbLightSwitch(
-                    hass, tv_coordinator, name, lights_rgb, option, icon, min_brightness, max_brightness
+                    hass, tv_coordinator, name, lights_rgb, option, icon, min_brightness, max_brightness, change_threshold, max_staleness, make_filter(filter_config), gamma, white_balance, direct_updates
                 )
             )
         if lights_ct is not None:
             dev.append(
                 AmbiHueCtLightSwitch(
-                    hass, tv_coordinator, name, lights_ct, option, icon, min_brightness, max_brightness
+                    hass, tv_coordinator, name, lights_ct, option, icon, min_brightness, max_brightness, change_threshold, max_staleness, make_filter(filter_config), gamma, white_balance, direct_updates
+                )
+            )
+        if wled_host is not None:
+            dev.append(
+                AmbiHueStripSwitch(
+                    hass, tv_coordinator, name, wled_host, strip_sides, icon, max_brightness, segments, reverse, max_staleness, gamma, white_balance
+                )
+            )
+        for conf, protocol in ((CONF_DDP, DDP), (CONF_E131, E131)):
+            if data.get(conf) is None:
+                continue
+            if segments is None:
+                _LOGGER.error('The ' + protocol + ' output of ' + name + ' needs the number of leds in segments.')
+                continue
+            dev.append(
+                AmbiHueUdpSwitch(
+                    hass, tv_coordinator, name, data.get(conf), protocol, strip_sides, icon, segments, max_brightness, reverse, gamma, white_balance, universe
                 )
             )
 
     async_add_entities(dev, True)
 
+@callback
+def async_get_music_server(hass: HomeAssistant) -> MusicServer:
+    # one music mode server is shared by all yeelights of all platform entries
+    data = hass.data.setdefault(DOMAIN, {})
+    if 'music_server' not in data:
+        music_server = data['music_server'] = MusicServer()
+
+        async def async_stop_music_server(event):
+            await music_server.async_stop()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop_music_server)
+    return data['music_server']
+
+@callback
+def async_get_tv_coordinator(hass: HomeAssistant, tvip, *settings) -> AmbiHue:
+    # one coordinator (so one polling loop and one connection) per tv, shared by all platform entries using it
+    data = hass.data.setdefault(DOMAIN, {})
+    if 'coordinators' not in data:
+        coordinators = data['coordinators'] = {}
+
+        async def async_stop_coordinators(event):
+            await asyncio.gather(*(coordinator.async_close() for coordinator in list(coordinators.values())), return_exceptions=True)
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop_coordinators)
+    coordinators = data['coordinators']
+    if tvip not in coordinators:
+        coordinators[tvip] = AmbiHue(hass, tvip, *settings)
+    elif coordinators[tvip].settings != settings:
+        _LOGGER.warning('The TV at ' + tvip + ' is configured more than once with different settings, using the settings it was first set up with.')
+    return coordinators[tvip]
+
 class AmbiHueYeeSwitch(SwitchEntity):
 
-    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, name, bulbips: string, option, icon, min_brightness, max_brightness) -> None:
+    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, music_server: MusicServer, name, bulbips: string, option, icon, min_brightness, max_brightness, change_threshold=DEFAULT_CHANGE_THRESHOLD, max_staleness=DEFAULT_MAX_STALENESS, color_filter=None, state_ttl=DEFAULT_STATE_TTL, gamma=DEFAULT_GAMMA, white_balance=DEFAULT_WHITE_BALANCE) -> None:
         self._hass = hass
         self._name = name
         self._position = option
@@ -158,17 +298,21 @@ class AmbiHueYeeSwitch(SwitchEntity):
         self._available = False
         self._ambihue: AmbiHue = tv_coordinator
 
+        self._state_ttl = state_ttl # seconds a bulb's cached power/music state is trusted
         self._bulbips = bulbips.split(', ')
-        self._bulbs: list[Bulb] = []
+        self._bulbs: list[AsyncBulb] = []
         for address in self._bulbips:
-            self._bulbs.append(Bulb(address))
+            self._bulbs.append(AsyncBulb(address, music_server))
+        self._limiters = {bulb: RateLimiter() for bulb in self._bulbs}
+        self._pending: dict[AsyncBulb, tuple] = {} # latest frame not sent to a bulb yet
+        self._senders: dict[AsyncBulb, asyncio.Future] = {} # per bulb task sending its pending frame
+        self._recovering: dict[AsyncBulb, asyncio.Future] = {} # per bulb task restarting the music mode after a failure
 
         self._brightness_pct = 30 # initial brightness
-        self._min_brightness_pct = min_brightness
-        self._max_brightness_pct = max_brightness
         self._brightness = int((self._brightness_pct / 100) * 254) # initial brightness
-        self._min_brightness = int((self._min_brightness_pct / 100) * 254)
-        self._max_brightness = int((self._max_brightness_pct / 100) * 254)
+        self._pipeline = ColorPipeline(min_brightness, max_brightness, gamma, white_balance) # brightness curve and colour calibration
+        self._change_gate = ChangeGate(change_threshold, max_staleness) # skips updates the eye wouldn't notice
+        self._filter = color_filter # optional temporal smoothing of the region colour
 
     @property
     def name(self) -> str:
@@ -187,6 +331,10 @@ class AmbiHueYeeSwitch(SwitchEntity):
     def available(self):
         return self._available
 
+    @property
+    def extra_state_attributes(self):
+        return {'rate_limits': {bulb.ip: limiter.as_dict() for bulb, limiter in self._limiters.items()}}
+
     async def async_turn_on(self, **kwargs):
         await self.async_turn_on_bulbs_and_music()
         await self.async_update()
@@ -198,58 +346,68 @@ class AmbiHueYeeSwitch(SwitchEntity):
     async def async_turn_on_bulbs_and_music(self):
         await asyncio.gather(*(self.async_turn_on_bulb_and_music(bulb) for bulb in self._bulbs), return_exceptions=True)
     
-    async def async_turn_on_bulb_and_music(self, bulb: Bulb):
+    async def async_turn_on_bulb_and_music(self, bulb: AsyncBulb):
         powerstate, musicmode = await self.async_getState(bulb)
         if not powerstate:
-            bulb.turn_on()
+            await bulb.async_turn_on()
         if not musicmode:
-            bulb.start_music()
+            await bulb.async_start_music()
 
     async def async_turn_on_bulbs(self):
         await asyncio.gather(*(self.async_turn_on_bulb(bulb) for bulb in self._bulbs), return_exceptions=True)
 
-    async def async_turn_on_bulb(self, bulb: Bulb):
+    async def async_turn_on_bulb(self, bulb: AsyncBulb):
         powerstate, musicmode = await self.async_getState(bulb)
         if not powerstate:
-            bulb.turn_on()
+            await bulb.async_turn_on()
 
     async def async_turn_off_bulbs(self):
         await asyncio.gather(*(self.async_turn_off_bulb(bulb) for bulb in self._bulbs), return_exceptions=True)
     
-    async def async_turn_off_bulb(self, bulb: Bulb):
+    async def async_turn_off_bulb(self, bulb: AsyncBulb):
         powerstate, musicmode = await self.async_getState(bulb)
         if powerstate:
-            bulb.turn_off()
+            await bulb.async_turn_off()
     
     async def async_start_music_bulbs(self):
         await asyncio.gather(*(self.async_start_music_bulb(bulb) for bulb in self._bulbs), return_exceptions=True)
     
-    async def async_start_music_bulb(self, bulb: Bulb):
+    async def async_start_music_bulb(self, bulb: AsyncBulb):
         powerstate, musicmode = await self.async_getState(bulb)
         if not musicmode:
-            bulb.start_music()
+            await bulb.async_start_music()
 
     async def async_stop_music_bulbs(self):
         await asyncio.gather(*(self.async_stop_music_bulb(bulb) for bulb in self._bulbs), return_exceptions=True)
     
-    async def async_stop_music_bulb(self, bulb: Bulb):
+    async def async_stop_music_bulb(self, bulb: AsyncBulb):
         powerstate, musicmode = await self.async_getState(bulb)
         if musicmode:
-            bulb.stop_music()
+            await bulb.async_stop_music()
 
     async def async_turn_off(self, **kwargs: Any) -> None:
         self._ambihue.remove_listener(self)
         self._follow = False
         self._is_on = False
+        self.cancel_senders()
         await self.async_stop_music_bulbs() # disables (more intensive) music mode afterward
         await self.async_turn_off_bulbs()
         _LOGGER.debug('AmbiYeelight turned off')
 
-    async def async_getState(self, bulb: Bulb):
+    async def async_added_to_hass(self) -> None:
+        self._ambihue.acquire()
+
+    async def async_will_remove_from_hass(self) -> None:
+        self._ambihue.remove_listener(self)
+        self.cancel_senders()
+        await asyncio.gather(*(bulb.async_close() for bulb in self._bulbs), return_exceptions=True)
+        await self._ambihue.async_release()
+
+    async def async_getState(self, bulb: AsyncBulb):
         power_on = False
         musicmode = False
         try:
-            properties = bulb.get_properties()
+            properties = await bulb.async_get_properties(max_age=self._state_ttl)
             if properties:
                 powerstate = properties['power']
                 musicmode = bulb.music_mode
@@ -263,76 +421,124 @@ class AmbiHueYeeSwitch(SwitchEntity):
         return power_on, musicmode
 
     async def async_update(self) -> None:
-        for bulb in self._bulbs:
-            powerstate, musicmode = await self.async_getState(bulb)
-            if powerstate and musicmode:
-                self._is_on = True
-            else:
-                self._is_on = False
-                return
+        states = await asyncio.gather(*(self.async_getState(bulb) for bulb in self._bulbs))
+        self._is_on = all(powerstate and musicmode for powerstate, musicmode in states)
 
-    async def async_is_update_needed(self, r, g, b, brightness):
-        if brightness != self._brightness:
-            return True
-        if r != self._r:
-            return True
-        if g != self._g:
-            return True
-        if b != self._b:
+    async def async_set_bulb(self, bulb: AsyncBulb, dim, params, line, frame_time=None, on_sent=None):
+        start = time.monotonic()
+        try:
+            if dim:
+                await bulb.async_set_brightness(1)
+            if params is not None:
+                if bulb.music_mode:
+                    if not bulb.send_music(line): # dropped, the bulb can't keep up and keeps its previous colour
+                        self._limiters[bulb].record(time.monotonic() - start, False) # backs off, without restarting the music mode
+                        self._ambihue.metrics.skipped_frames += 1
+                        return False
+                else:
+                    await bulb.async_send_command('start_cf', params)
+            rtt = time.monotonic() - start
+            self._limiters[bulb].record(rtt, True)
+            self._ambihue.metrics.command(bulb.ip, rtt, True, frame_time)
+            if on_sent is not None:
+                on_sent()
             return True
-        return False
+        except Exception as e:
+            self._limiters[bulb].record(time.monotonic() - start, False)
+            self._ambihue.metrics.command(bulb.ip, None, False)
+            _LOGGER.error('Failed to set the bulb color values with error (going to try to start the music mode again):' + str(e))
+            recovering = self._recovering.get(bulb)
+            if recovering is None or recovering.done():
+                self._recovering[bulb] = asyncio.ensure_future(self.async_recover_bulb(bulb))
+            return False
 
-    async def async_set_bulb(self, r, g, b, brightness, bulb: Bulb, ambiSetting):
+    async def async_recover_bulb(self, bulb: AsyncBulb):
+        # runs beside the sender, so a bulb that is gone doesn't hold up the frames of the others
+        try:
+            await self.async_turn_on_bulb_and_music(bulb)
+        except Exception as e:
+            _LOGGER.error('Failed to restart the music mode of ' + bulb.ip + ' with error: ' + str(e))
+
+    def start_senders(self):
+        for bulb in self._pending:
+            sender = self._senders.get(bulb)
+            if sender is None or sender.done():
+                self._senders[bulb] = asyncio.ensure_future(self.async_send_pending(bulb))
+
+    def cancel_senders(self):
+        self._pending.clear()
+        for task in chain(self._senders.values(), self._recovering.values()):
+            task.cancel()
+        self._senders.clear()
+        self._recovering.clear()
+
+    async def async_send_pending(self, bulb: AsyncBulb):
+        # the follow loop never waits on a bulb: frames arriving while it is throttled or busy replace the pending one
+        limiter = self._limiters[bulb]
+        while bulb in self._pending:
+            wait = limiter.wait(time.monotonic(), 0 if bulb.music_mode else YEELIGHT_QUOTA_INTERVAL)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            frame = self._pending.pop(bulb)
+            limiter.started(time.monotonic())
+            await self.async_set_bulb(bulb, *frame)
+
+    def apply_filter(self, r, g, b):
+        if self._filter is None:
+            return r, g, b
+        if r is None:
+            self._filter.reset()
+            return r, g, b
+        return self._filter.apply(r, g, b)
+
+    async def async_update_bulbs(self, r, g, b):
         try:
-            if brightness < self._min_brightness:
-                brightness = self._min_brightness
-            if self._max_brightness_pct < 100:
-                brightness = brightness / 100 * self._max_brightness_pct
-            if brightness > self._max_brightness:
-                brightness = self._max_brightness
+            frame_time = self._ambihue.frame_time
+            r, g, b = self.apply_filter(r, g, b)
+            value = 5 if r is None else luminance(r, g, b)
+            if not self._change_gate.is_update_needed(r, g, b, value):
+                self._ambihue.metrics.suppressed_updates += 1 # bulbs that were throttled still get their pending colour
+                return True
+            sample = (r, g, b, value)
+            ambiSetting = self._ambihue.ambilight_current_configuration
+
+            brightness = self._pipeline.brightness(value)
 
+            dim = False
             if r == None and g == None and b == None: # incase of a failure somewhere
                 _LOGGER.error('RGB values are None.')
                 r,g,b = DEFAULT_RGB_COLOR[0], DEFAULT_RGB_COLOR[1], DEFAULT_RGB_COLOR[2]
-                bulb.set_brightness(1)
-            
+                dim = True
+
+            params = line = None
             if r == 0 and g == 0 and b == 0: # dim bulb in game mode
                 if 'menuSetting' in ambiSetting and ambiSetting['menuSetting'] == "GAME":
                     r,g,b = DEFAULT_RGB_COLOR[0], DEFAULT_RGB_COLOR[1], DEFAULT_RGB_COLOR[2]
-                    bulb.set_brightness(1)
+                    dim = True
             else:
                 if ambiSetting['styleName'] == "FOLLOW_VIDEO":
-                    transitions = [RGBTransition(r,g,b,duration=300,brightness=brightness)] # this transition can be customised (see: https://yeelight.readthedocs.io/en/latest/yeelight.html#yeelight.Flow)
+                    duration = 300 # the transition can be customised (see: https://yeelight.readthedocs.io/en/latest/yeelight.html#yeelight.Flow)
                 else:
-                    transitions = [RGBTransition(r,g,b,duration=200,brightness=brightness)]
-                flow = Flow(
-                    count=1,
-                    action=Flow.actions.stay,
-                    transitions=transitions)
-                bulb.start_flow(flow)
+                    duration = 200
+                r, g, b = self._pipeline.color(r, g, b)
+                params, line = encode_color_flow(r, g, b, brightness, duration) # line is sent as is to all bulbs in music mode
+
+            on_sent = None
+            if params is not None:
                 self._brightness = brightness
-                self._r, self._g, self._b = r, g, b
-                return True
+                on_sent = partial(self._change_gate.sent, *sample) # the gate compares with it once a bulb got it
+            for bulb in self._bulbs:
+                self._pending[bulb] = (dim, params, line, frame_time, on_sent)
+            self.start_senders()
+            return True
         except Exception as e:
-            _LOGGER.error('Failed to set the bulb color values with error (going to try to start the music mode again):' + str(e))
-            await self.async_turn_on_bulb_and_music(bulb)
-            return False
-
-    async def async_update_bulbs(self):
-        try:
-            r, g, b = await self._ambihue.async_get_rgb(self._ambihue._layer, self._position)
-            brightness = await self._ambihue.async_get_brightness(r, g, b)
-            if not self.async_is_update_needed(r, g, b, brightness):
-                return True
-            ambiSetting = self._ambihue._api.ambilight_current_configuration
-            await asyncio.gather(*(self.async_set_bulb(r, g, b, brightness, bulb, ambiSetting) for bulb in self._bulbs), return_exceptions=True)
-        except:
             _LOGGER.error('Failed async_update_bulbs: ' + str(e))
             return False
 
 class AmbiHueRgbLightSwitch(SwitchEntity):
 
-    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, name, lights_rgb: string, option, icon, min_brightness, max_brightness) -> None:
+    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, name, lights_rgb: string, option, icon, min_brightness, max_brightness, change_threshold=DEFAULT_CHANGE_THRESHOLD, max_staleness=DEFAULT_MAX_STALENESS, color_filter=None, gamma=DEFAULT_GAMMA, white_balance=DEFAULT_WHITE_BALANCE, direct_updates=DEFAULT_DIRECT_UPDATES) -> None:
         self._hass = hass
         self._name = name
         self._position = option
@@ -344,17 +550,13 @@ class AmbiHueRgbLightSwitch(SwitchEntity):
 
         self._lights_types = dict(zip(lights_rgb, repeat("rgb")))
         self._lights = list(self._lights_types.keys())
+        self._direct_updates = direct_updates # the lights are turned on without the light.turn_on service while following
 
         self._brightness_pct = 30 # initial brightness
-        self._min_brightness_pct = min_brightness
-        self._max_brightness_pct = max_brightness
         self._brightness = int((self._brightness_pct / 100) * 254) # initial brightness
-        self._min_brightness = int((self._min_brightness_pct / 100) * 254)
-        self._max_brightness = int((self._max_brightness_pct / 100) * 254)
-
-        self._r = 0
-        self._g = 0
-        self._b = 0
+        self._pipeline = ColorPipeline(min_brightness, max_brightness, gamma, white_balance) # brightness curve and colour calibration
+        self._change_gate = ChangeGate(change_threshold, max_staleness) # skips updates the eye wouldn't notice
+        self._filter = color_filter # optional temporal smoothing of the region colour
 
     @property
     def name(self) -> str:
@@ -373,12 +575,18 @@ class AmbiHueRgbLightSwitch(SwitchEntity):
     def available(self):
         return self._available
 
+    @property
+    def extra_state_attributes(self):
+        return {'rate_limits': self._ambihue.rate_limits(self._lights)}
+
     async def async_turn_on(self, **kwargs):
         # await self._ambihue.async_update()
         await self.async_turn_on_bulbs()
         await self.async_update()
         if self._is_on:
             self._follow = True
+            if self._direct_updates:
+                self._ambihue.resolve_lights(self._lights)
             self._ambihue.add_listener(self)
             _LOGGER.debug('Ambi RGB Light turned on')
 
@@ -445,6 +653,13 @@ class AmbiHueRgbLightSwitch(SwitchEntity):
         await self.async_turn_off_bulbs()
         _LOGGER.debug('Ambi rgblight turned off')
 
+    async def async_added_to_hass(self) -> None:
+        self._ambihue.acquire()
+
+    async def async_will_remove_from_hass(self) -> None:
+        self._ambihue.remove_listener(self)
+        await self._ambihue.async_release()
+
     async def async_update(self) -> None:
         for light in self._lights:
             if self.hass.states.get(light) == STATE_UNAVAILABLE:
@@ -455,59 +670,46 @@ class AmbiHueRgbLightSwitch(SwitchEntity):
                 self._is_on = False
                 return
     
-    async def async_is_update_needed(self, r, g, b, brightness):
-        if brightness != self._brightness:
-            return True
-        if r != self._r:
-            return True
-        if g != self._g:
-            return True
-        if b != self._b:
-            return True
-        return False
-
-    async def async_update_bulbs(self):
+    def apply_filter(self, r, g, b):
+        if self._filter is None:
+            return r, g, b
+        if r is None:
+            self._filter.reset()
+            return r, g, b
+        return self._filter.apply(r, g, b)
+
+    async def async_update_bulbs(self, r, g, b):
         try:
-            r, g, b = await self._ambihue.async_get_rgb(self._ambihue._layer, self._position)
-            brightness = await self._ambihue.async_get_brightness(r, g, b)
+            r, g, b = self.apply_filter(r, g, b)
+            value = 5 if r is None else luminance(r, g, b)
             
-            if not self.async_is_update_needed(r, g, b, brightness):
+            if not self._change_gate.is_update_needed(r, g, b, value):
+                self._ambihue.metrics.suppressed_updates += 1
                 return True
+            sample = (r, g, b, value)
             
-            if brightness < self._min_brightness:
-                brightness = self._min_brightness
-            if self._max_brightness_pct < 100:
-                brightness = brightness / 100 * self._max_brightness_pct
-            if brightness > self._max_brightness:
-                brightness = self._max_brightness
-            ambiSetting = self._ambihue._api.ambilight_current_configuration
+            brightness = self._pipeline.brightness(value)
+            ambiSetting = self._ambihue.ambilight_current_configuration
             duration = 200 / 1000
             if r == None and g == None and b == None: # incase of a failure somewhere
                 _LOGGER.error('RGB values are None.')
                 r,g,b = DEFAULT_RGB_COLOR[0], DEFAULT_RGB_COLOR[1], DEFAULT_RGB_COLOR[2]
-                brightness = self._min_brightness
+                brightness = self._pipeline.min_brightness
             if 'menuSetting' in ambiSetting and ambiSetting['menuSetting'] == "GAME":
                 if r == 0 and g == 0 and b == 0: # dim bulb in game mode
                     r,g,b = DEFAULT_RGB_COLOR[0], DEFAULT_RGB_COLOR[1], DEFAULT_RGB_COLOR[2]
-                    brightness = self._min_brightness
+                    brightness = self._pipeline.min_brightness
             else:
                 if ambiSetting['styleName'] == "FOLLOW_VIDEO":
                     duration = 300 / 1000
 
-            tasks = []
-            for light in self._lights:
-                service_data = {ATTR_ENTITY_ID: light, ATTR_TRANSITION: duration}
-                service_data[ATTR_BRIGHTNESS] = int(brightness)
-                service_data[ATTR_RGB_COLOR] = (int(r), int(g), int(b))
-                tasks.append(
-                self.hass.services.async_call(
-                        LIGHT_DOMAIN, SERVICE_TURN_ON, service_data
-                    )
-                )
-            if tasks:
-                await asyncio.wait(tasks, timeout=2)
+            service_data = {ATTR_TRANSITION: duration}
+            service_data[ATTR_BRIGHTNESS] = int(brightness)
+            service_data[ATTR_RGB_COLOR] = self._pipeline.color(r, g, b)
+            if self._lights:
+                # sent with the other lights of this frame, the gate compares with it once it arrived
+                self._ambihue.queue_light_update(self._lights, service_data, partial(self._change_gate.sent, *sample))
                 self._brightness = brightness
-                self._r, self._g, self._b = r, g, b
             return True
         except Exception as e:
             _LOGGER.error('Unable to set the light colors' + str(e))
@@ -515,7 +717,7 @@ class AmbiHueRgbLightSwitch(SwitchEntity):
 
 class AmbiHueCtLightSwitch(SwitchEntity):
 
-    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, name, lights_ct: string, option, icon, min_brightness, max_brightness) -> None:
+    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, name, lights_ct: string, option, icon, min_brightness, max_brightness, change_threshold=DEFAULT_CHANGE_THRESHOLD, max_staleness=DEFAULT_MAX_STALENESS, color_filter=None, gamma=DEFAULT_GAMMA, white_balance=DEFAULT_WHITE_BALANCE, direct_updates=DEFAULT_DIRECT_UPDATES) -> None:
         self._hass = hass
         self._name = name
         self._position = option
@@ -527,13 +729,13 @@ class AmbiHueCtLightSwitch(SwitchEntity):
 
         self._lights_types = dict(zip(lights_ct, repeat("ct")))
         self._lights = list(self._lights_types.keys())
+        self._direct_updates = direct_updates # the lights are turned on without the light.turn_on service while following
 
         self._brightness_pct = 30 # initial brightness
-        self._min_brightness_pct = min_brightness
-        self._max_brightness_pct = max_brightness
         self._brightness = int((self._brightness_pct / 100) * 254) # initial brightness
-        self._min_brightness = int((self._min_brightness_pct / 100) * 254)
-        self._max_brightness = int((self._max_brightness_pct / 100) * 254)
+        self._pipeline = ColorPipeline(min_brightness, max_brightness, gamma, white_balance) # brightness curve and colour calibration
+        self._change_gate = ChangeGate(change_threshold, max_staleness) # skips updates the eye wouldn't notice
+        self._filter = color_filter # optional temporal smoothing of the region colour
 
     @property
     def name(self) -> str:
@@ -552,11 +754,17 @@ class AmbiHueCtLightSwitch(SwitchEntity):
     def available(self):
         return self._available
 
+    @property
+    def extra_state_attributes(self):
+        return {'rate_limits': self._ambihue.rate_limits(self._lights)}
+
     async def async_turn_on(self, **kwargs):
         await self.async_turn_on_bulbs()
         await self.async_update()
         if self._is_on:
             self._follow = True
+            if self._direct_updates:
+                self._ambihue.resolve_lights(self._lights)
             self._ambihue.add_listener(self)
             _LOGGER.debug('Ambi CT Light turned on')
 
@@ -620,6 +828,13 @@ class AmbiHueCtLightSwitch(SwitchEntity):
         await self.async_turn_off_bulbs()
         _LOGGER.debug('Ambi ctlight turned off')
 
+    async def async_added_to_hass(self) -> None:
+        self._ambihue.acquire()
+
+    async def async_will_remove_from_hass(self) -> None:
+        self._ambihue.remove_listener(self)
+        await self._ambihue.async_release()
+
     async def async_update(self) -> None:
         for light in self._lights:
             if self.hass.states.get(light) == STATE_UNAVAILABLE:
@@ -630,130 +845,443 @@ class AmbiHueCtLightSwitch(SwitchEntity):
                 self._is_on = False
                 return
 
-    async def async_is_update_needed(self, brightness):
-        if brightness != self._brightness:
-            return True
-        return False
+    def apply_filter(self, r, g, b):
+        if self._filter is None:
+            return r, g, b
+        if r is None:
+            self._filter.reset()
+            return r, g, b
+        return self._filter.apply(r, g, b)
 
-    async def async_update_bulbs(self):
+    async def async_update_bulbs(self, r, g, b):
         try:
-            r, g, b = await self._ambihue.async_get_rgb(self._ambihue._layer, self._position)
-            brightness = await self._ambihue.async_get_brightness(r, g, b)
+            r, g, b = self.apply_filter(r, g, b)
+            value = 5 if r is None else luminance(r, g, b)
 
-            if not self.async_is_update_needed(brightness):
+            if not self._change_gate.is_update_needed(None, None, None, value):
+                self._ambihue.metrics.suppressed_updates += 1
                 return True
+            sample = (None, None, None, value)
 
-            if brightness < self._min_brightness:
-                brightness = self._min_brightness
-            if self._max_brightness_pct < 100:
-                brightness = brightness / 100 * self._max_brightness_pct
-            if brightness > self._max_brightness:
-                brightness = self._max_brightness
-            ambiSetting = self._ambihue._api.ambilight_current_configuration
+            brightness = self._pipeline.brightness(value)
+            ambiSetting = self._ambihue.ambilight_current_configuration
             duration = 200 / 1000
             if r == None and g == None and b == None: # incase of a failure somewhere
                 _LOGGER.error('RGB values are None.')
                 r,g,b = DEFAULT_RGB_COLOR[0], DEFAULT_RGB_COLOR[1], DEFAULT_RGB_COLOR[2]
-                brightness = self._min_brightness
+                brightness = self._pipeline.min_brightness
             if 'menuSetting' in ambiSetting and ambiSetting['menuSetting'] == "GAME":
                 if r == 0 and g == 0 and b == 0: # dim bulb in game mode
                     r,g,b = DEFAULT_RGB_COLOR[0], DEFAULT_RGB_COLOR[1], DEFAULT_RGB_COLOR[2]
-                    brightness = self._min_brightness
+                    brightness = self._pipeline.min_brightness
             else:
                 if ambiSetting['styleName'] == "FOLLOW_VIDEO":
                     duration = 300 / 1000
-            tasks = []
-            for light in self._lights:
-                service_data = {ATTR_ENTITY_ID: light, ATTR_TRANSITION: duration}
-                service_data[ATTR_BRIGHTNESS] = int(brightness)
-                tasks.append(
-                self.hass.services.async_call(
-                        LIGHT_DOMAIN, SERVICE_TURN_ON, service_data
-                    )
-                )
-            if tasks:
-                await asyncio.wait(tasks, timeout=2)
+            service_data = {ATTR_TRANSITION: duration}
+            service_data[ATTR_BRIGHTNESS] = int(brightness)
+            if self._lights:
+                # sent with the other lights of this frame, the gate compares with it once it arrived
+                self._ambihue.queue_light_update(self._lights, service_data, partial(self._change_gate.sent, *sample))
                 self._brightness = brightness
             return True
         except Exception as e:
             _LOGGER.error('Unable to set the light colors' + str(e))
             return False
 
+class AmbiHueStripSwitch(SwitchEntity):
+    """Reproduces a run of ambilight pixels on a segmented led strip (WLED), with a single request per frame."""
+
+    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, name, host, sides, icon, max_brightness, segments=None, reverse=False, max_staleness=DEFAULT_MAX_STALENESS, gamma=DEFAULT_GAMMA, white_balance=DEFAULT_WHITE_BALANCE) -> None:
+        self._hass = hass
+        self._name = name
+        self._icon = icon
+        self._is_on = False
+        self._available = False
+        self._ambihue: AmbiHue = tv_coordinator
+
+        self._client = WledClient(hass, host)
+        self._sides = tuple(sides)
+        self._segments = segments # None gives every led its own segment
+        self._reverse = reverse
+        self._leds = None # number of leds of the strip, read from the controller when turned on
+        self._position: Strip | None = None # the strip region, known once the number of leds is
+        self._max_brightness_pct = max_brightness
+        self._max_staleness = max_staleness
+        self._pipeline = ColorPipeline(gamma=gamma, white_balance=white_balance) # colour calibration
+        self._limiter = RateLimiter()
+        self._sent = None # segment colours last sent to the strip
+        self._sent_time = None
+        self._pending = None # (payload, segment colours, frame time) of the latest frame not sent yet
+        self._sending: asyncio.Future | None = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend, if any."""
+        return self._icon
+
+    @property
+    def is_on(self) -> bool:
+        return self._is_on
+
+    @property
+    def available(self):
+        return self._available
+
+    @property
+    def extra_state_attributes(self):
+        return {
+            'leds': self._leds,
+            'segments': None if self._position is None else self._position.segments,
+            'rate_limits': {self._client.host: self._limiter.as_dict()},
+        }
+
+    async def async_turn_on(self, **kwargs):
+        try:
+            if self._leds is None:
+                self._leds = await self._client.async_get_led_count()
+            await self._client.async_set_state({'on': True, 'bri': int(self._max_brightness_pct / 100 * 255)})
+            self._is_on = True
+            self._available = True
+        except Exception as e:
+            _LOGGER.error('Failed to turn on the led strip ' + self._client.host + ' with error: ' + str(e))
+            self._available = False
+            return
+        self._position = Strip(self._sides, min(self._segments or self._leds, self._leds), self._reverse)
+        self._ambihue.add_listener(self)
+        _LOGGER.debug('Ambi led strip turned on')
+
+    async def async_turn_off(self, **kwargs: Any) -> None:
+        self._ambihue.remove_listener(self)
+        self._is_on = False
+        self.cancel()
+        try:
+            await self._client.async_set_state({'on': False})
+        except Exception as e:
+            _LOGGER.error('Failed to turn off the led strip ' + self._client.host + ' with error: ' + str(e))
+        _LOGGER.debug('Ambi led strip turned off')
+
+    async def async_added_to_hass(self) -> None:
+        self._ambihue.acquire()
+
+    async def async_will_remove_from_hass(self) -> None:
+        self._ambihue.remove_listener(self)
+        self.cancel()
+        await self._client.async_close()
+        await self._ambihue.async_release()
+
+    async def async_update(self) -> None:
+        try:
+            state = await self._client.async_get('state')
+            self._is_on = state.get('on', False)
+            self._available = True
+        except Exception as e:
+            _LOGGER.debug('Failed to get the state of the led strip ' + self._client.host + ': ' + str(e))
+            self._available = False
+
+    def cancel(self):
+        self._pending = None
+        if self._sending is not None:
+            self._sending.cancel()
+            self._sending = None
+
+    async def async_update_bulbs(self, *colors):
+        # gets the (r, g, b) of every segment, or NO_COLOR when the tv can't provide the pixels of the strip
+        try:
+            if colors[0] is None:
+                return True
+            if colors == self._sent and time.monotonic() - self._sent_time < self._max_staleness:
+                self._ambihue.metrics.suppressed_updates += 1
+                return True
+            color = self._pipeline.color
+            payload = encode_leds([color(r, g, b) for r, g, b in colors], self._leds)
+            self._pending = (payload, colors, self._ambihue.frame_time)
+            if self._sending is None or self._sending.done():
+                self._sending = asyncio.ensure_future(self.async_send_pending())
+            return True
+        except Exception as e:
+            _LOGGER.error('Failed async_update_bulbs: ' + str(e))
+            return False
+
+    async def async_send_pending(self):
+        # the follow loop never waits on the strip: frames arriving while a request is in flight replace the pending one
+        while self._pending is not None:
+            payload, colors, frame_time = self._pending
+            self._pending = None
+            start = time.monotonic()
+            try:
+                await self._client.async_set_leds(payload)
+                rtt = time.monotonic() - start
+                self._limiter.record(rtt, True)
+                self._ambihue.metrics.command(self._client.host, rtt, True, frame_time)
+                self._sent = colors
+                self._sent_time = start
+            except Exception as e:
+                rtt = time.monotonic() - start
+                self._limiter.record(rtt, False)
+                self._ambihue.metrics.command(self._client.host, None, False)
+                _LOGGER.error('Failed to set the led strip colours with error: ' + str(e))
+            await asyncio.sleep(max(0, self._limiter.interval - rtt)) # slow or failing strips get fewer frames
+
+class AmbiHueUdpSwitch(SwitchEntity):
+    """Streams a run of ambilight pixels to an LED controller over DDP or E1.31, without HTTP or state writes."""
+
+    def __init__(self, hass: HomeAssistant, tv_coordinator: AmbiHue, name, host, protocol, sides, icon, pixels, max_brightness, reverse=False, gamma=DEFAULT_GAMMA, white_balance=DEFAULT_WHITE_BALANCE, universe=DEFAULT_UNIVERSE, port=None) -> None:
+        self._hass = hass
+        self._name = name
+        self._icon = icon
+        self._is_on = False
+        self._ambihue: AmbiHue = tv_coordinator
+
+        self._output = UdpOutput(host, protocol, port, universe)
+        self._position = Strip(tuple(sides), pixels, reverse)
+        # max_brightness scales the channels, together with the calibration, in the same lookup tables
+        self._pipeline = ColorPipeline(gamma=gamma, white_balance=[gain * max_brightness / 100 for gain in white_balance])
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend, if any."""
+        return self._icon
+
+    @property
+    def is_on(self) -> bool:
+        return self._is_on
+
+    @property
+    def extra_state_attributes(self):
+        return {'protocol': self._output.protocol, 'pixels': self._position.segments, 'datagrams_per_frame': self._output.datagrams}
+
+    async def async_turn_on(self, **kwargs):
+        try:
+            await self._output.async_open()
+        except OSError as e:
+            _LOGGER.error('Failed to open the ' + self._output.protocol + ' output to ' + self._output.host + ': ' + str(e))
+            return
+        self._is_on = True
+        self._ambihue.add_listener(self)
+        _LOGGER.debug('Ambi ' + self._output.protocol + ' output turned on')
+
+    async def async_turn_off(self, **kwargs: Any) -> None:
+        self._ambihue.remove_listener(self)
+        self._is_on = False
+        self._output.send(bytes(self._position.segments * 3)) # black, the controller returns to its own effects after its realtime timeout
+        self._output.close()
+        _LOGGER.debug('Ambi ' + self._output.protocol + ' output turned off')
+
+    async def async_added_to_hass(self) -> None:
+        self._ambihue.acquire()
+
+    async def async_will_remove_from_hass(self) -> None:
+        self._ambihue.remove_listener(self)
+        self._output.close()
+        await self._ambihue.async_release()
+
+    async def async_update_bulbs(self, *colors):
+        # gets the (r, g, b) of every pixel, or NO_COLOR when the tv can't provide the pixels of the strip
+        try:
+            if colors[0] is None:
+                return True
+            start = time.monotonic()
+            self._output.send(self._pipeline.pixels(colors)) # every frame, controllers leave realtime mode when the frames stop
+            self._ambihue.metrics.command(self._output.host, time.monotonic() - start, True, self._ambihue.frame_time)
+            return True
+        except Exception as e:
+            self._ambihue.metrics.command(self._output.host, None, False)
+            _LOGGER.error('Failed to send the ' + self._output.protocol + ' frame with error: ' + str(e))
+            return False
+
 class AmbiHue:
     """The class for handling the data retrieval."""
     
-    def __init__(self, hass: HomeAssistant, tvip, api_version, user, password) -> None:
+    def __init__(self, hass: HomeAssistant, tvip, api_version, user, password, vectorized=False, frame_rate=DEFAULT_FRAME_RATE, min_frame_rate=None, timeout=TIMEOUT, fast_decode=False, record_file=None, replay_file=None, replay_speed=DEFAULT_REPLAY_SPEED, port=None) -> None:
         self._hass = hass
         self._ambihueip = tvip
         self._user = user
         self._password = password
+        self.settings = (api_version, user, password, vectorized, frame_rate, min_frame_rate, timeout, fast_decode, record_file, replay_file, replay_speed)
+        self._references = 0 # entities using this coordinator, see async_get_tv_coordinator
 
         self._follow = False
+        self._future: asyncio.Future | None = None
+        self._frame_rate = frame_rate # target number of frames per second
+        self._min_frame_rate = min(min_frame_rate, frame_rate) if min_frame_rate else None # floor of the adaptive rate, disabled if None
+        self.metrics = Metrics() # frame rate, stage latencies and error counts, shown by the sensor platform
+        self.frame_time: float | None = None # monotonic time the current colours were requested from the tv
+        self._fetch_time: float | None = None
         self._on_update: list[Callable] = []
         self._layer = None
-        self._api = PhilipsTV(self._ambihueip, api_version, username=self._user, password=self._password)
+        self._compact = fast_decode # layers are decoded straight into compact per-side arrays (see decode.py)
+        self._recorder = FrameRecorder(hass, record_file) if record_file else None
+        self._replay_file = replay_file # frames come from this recording instead of the tv
+        self._replay_speed = replay_speed # times real time, 0 replays as fast as the listeners allow
+        if replay_file:
+            self._compact = True # recorded frames are compact
+        self._tv_sides: frozenset | None = None # sides of the tv's full layer, None until the next full fetch
+        self._colors: dict[str, tuple] = {}
+        self._extractor = RegionExtractor()
+        self._dispatcher = LightDispatcher(hass, self.metrics)
+        if vectorized:
+            try:
+                self._extractor = VectorRegionExtractor() # reduces all regions with numpy instead of python loops
+            except ImportError as e:
+                _LOGGER.warning('Falling back to the default region extractor: ' + str(e))
+        self._client = JointSpaceClient(hass, self._ambihueip, api_version, self._user, self._password, timeout, port=port)
+        self.ambilight_current_configuration = None
+        self.powerstate = None
+        self.ambilight_power = None
+
+    async def async_get_json(self, path):
+        try:
+            return await self._client.async_get(path)
+        except Exception as e:
+            _LOGGER.error('Failed to get ' + path + ' with error: ' + str(e))
+            return None
 
     async def async_update(self):
         _LOGGER.info('Update TV info')
-        await self._api.update()
+        self.ambilight_current_configuration = await self.async_get_json('ambilight/currentconfiguration')
+        powerstate = await self.async_get_json('powerstate')
+        self.powerstate = powerstate.get('powerstate') if powerstate else None
+        ambilight_power = await self.async_get_json('ambilight/power')
+        self.ambilight_power = ambilight_power.get('power') if ambilight_power else None
 
     async def async_get_ambilayer(self):
-        if self._api.ambilight_current_configuration is None:
+        if self.ambilight_current_configuration is None:
             return None
         try:
-            if self._api.ambilight_current_configuration['styleName'] == "FOLLOW_VIDEO":
-                currentstate = await self._api.getAmbilightMeasured() # uses pre-processing r,g,b values from tv (see: http://jointspace.sourceforge.net/projectdata/documentation/jasonApi/1/doc/API-ambilight.html)
+            if self.ambilight_current_configuration['styleName'] == "FOLLOW_VIDEO":
+                path = 'ambilight/measured' # uses pre-processing r,g,b values from tv (see: http://jointspace.sourceforge.net/projectdata/documentation/jasonApi/1/doc/API-ambilight.html)
             else:
-                currentstate = await self._api.getAmbilightProcessed() # uses post-processing r,g,b values from tv (allows yeelight bulb to follow tv's algorithms such as the follow audio effects and colours set by home assistant)
-            self._layer = currentstate['layer1']
+                path = 'ambilight/processed' # uses post-processing r,g,b values from tv (allows yeelight bulb to follow tv's algorithms such as the follow audio effects and colours set by home assistant)
+            sides = self._extractor.sides
+            start = time.monotonic()
+            if self._recorder is None and self._tv_sides is not None and len(sides) == 1 and sides < self._tv_sides: # recordings keep all sides
+                self._layer = await self._client.async_get_layer(path, sorted(sides), self._compact) # only the side the listeners use
+            else:
+                self._layer = await self._client.async_get_layer(path, compact=self._compact)
+                self._tv_sides = frozenset(side for side in SIDES if side in self._layer)
+            decode_time = self._client.decode_time
+            self.metrics.observe(STAGE_FETCH, time.monotonic() - start - decode_time)
+            self.metrics.observe(STAGE_DECODE, decode_time)
+            self._fetch_time = start
+            if self._recorder is not None:
+                self._recorder.record(self._layer if self._compact else flatten_layer(self._layer), self.ambilight_current_configuration)
         except Exception as e:
             self._layer = None
             _LOGGER.error('Failed to get ambilight layer with error:' + str(e))
         return self._layer
 
-    async def async_follow_ambilight(self, sleep, duration):
-        _LOGGER.info('Follow ambilight for ' + str(duration / sleep) + ' times for the next ' + str(duration) + ' seconds')
+    async def async_follow_ambilight(self, period, duration):
+        # frames are paced on a fixed grid of deadlines, so the time spent fetching is subtracted from the wait
+        # and the cadence doesn't drift. The next frame is fetched while the listeners are still pushing the
+        # previous one, and frames are skipped (not queued) when the fetch or the listeners fall behind.
+        _LOGGER.info('Follow ambilight for ' + str(duration / period) + ' times for the next ' + str(duration) + ' seconds')
+        loop = asyncio.get_running_loop()
         counter = 0
-        while self._follow == True and counter < (duration / sleep): # second loop for updating the bulb
+        slots = 0
+        frame_period = period
+        deadline = loop.time()
+        end = deadline + duration
+        notifying: asyncio.Future | None = None
+        self._tv_sides = None # the first frame fetches the full layer, to notice changes in the tv's topology
+        while self._follow == True and deadline < end: # second loop for updating the bulb
             await self.async_get_ambilayer()
             if self._layer is None:
                 _LOGGER.error('self._layer is None.')
+            elif notifying is not None and not notifying.done():
+                self.metrics.skipped_frames += 1 # the listeners are still busy with the previous frame
             else:
                 try:
-                    await self.notify_listeners()
+                    colors = await self.async_extract_regions()
+                    notifying = asyncio.ensure_future(self.notify_listeners(colors))
                     counter += 1
+                    self.metrics.frame()
+                    if self._min_frame_rate is not None:
+                        frame_period = self.get_adaptive_period(period, frame_period, self._extractor.delta)
                 except Exception as e:
-                    _LOGGER.error('Failed to transfer color values with error (from second loop):' + str(e))
-                    # self._follow = False
-            await asyncio.sleep(sleep)
-        return counter
+                    _LOGGER.error('Failed to transfer color values with error (from second loop):' + str(e)) # a bad frame doesn't stop following, the next deadline gets a new one
+            slots += 1
+            deadline += frame_period
+            now = loop.time()
+            if now > deadline:
+                missed = int((now - deadline) / frame_period) + 1
+                self.metrics.skipped_frames += missed
+                slots += missed
+                deadline += missed * frame_period
+            await asyncio.sleep(deadline - now)
+        if notifying is not None:
+            await notifying
+        return counter, slots
+
+    async def async_follow_replay(self):
+        # feeds a recording to the listeners instead of the tv, over and over, at replay_speed times real time
+        _LOGGER.info('Replaying ' + self._replay_file + ' at ' + str(self._replay_speed) + 'x')
+        try:
+            frames = await self._hass.async_add_executor_job(lambda: list(read_recording(self._replay_file)))
+        except (OSError, ValueError) as e:
+            _LOGGER.error('Failed to read the recording: ' + str(e))
+            frames = []
+        if not frames:
+            _LOGGER.error('There are no frames to replay in ' + self._replay_file)
+            self._follow = False
+            return False
+        offsets = frame_offsets(frames) # pauses between recording sessions are cut short
+        loop = asyncio.get_running_loop()
+        while self._follow == True:
+            start = loop.time()
+            for offset, (timestamp, configuration, frame) in zip(offsets, frames):
+                if self._replay_speed:
+                    delay = start + offset / self._replay_speed - loop.time()
+                    await asyncio.sleep(max(0, delay))
+                else:
+                    await asyncio.sleep(0) # lets the light updates run
+                if self._follow == False:
+                    break
+                self.ambilight_current_configuration = configuration
+                self._fetch_time = time.monotonic()
+                self._layer = frame
+                colors = await self.async_extract_regions()
+                self.metrics.frame()
+                await self.notify_listeners(colors)
+        return True
+
+    def get_adaptive_period(self, period, frame_period, delta):
+        # back off while the picture is static, down to min_frame_rate, and return to the full rate on the first change
+        if delta is None or delta >= SCENE_CHANGE_THRESHOLD:
+            return period
+        return min(frame_period * ADAPTIVE_BACKOFF, 1 / self._min_frame_rate)
 
-    async def async_follow_tv(self, sleep):
+    async def async_follow_tv(self, period):
         _LOGGER.debug('Starting async_follow_tv')
         while self._follow == True: # main loop for updating the bulb
             try:
-                await self._api.getAmbilightCurrentConfiguration()
-                if self._api.ambilight_current_configuration is None:
+                await self.async_update()
+                if self.ambilight_current_configuration is None:
                     _LOGGER.error('AmbiSetting is None. Trying again in 5 seconds')
-                    await self._api.update()
+                    await self._client.async_reset()
                     await asyncio.sleep(5)
                     continue
                 
-                await self._api.getPowerState()
-                await self._api.getAmbilightPower()
-                if self._api.ambilight_power == 'On' and self._api.powerstate == 'On':
-                    counter = await self.async_follow_ambilight(sleep, 10)
-                    if counter < (10/sleep) * 0.5:
+                if self.ambilight_power == 'On' and self.powerstate == 'On':
+                    counter, slots = await self.async_follow_ambilight(period, 10)
+                    if counter < slots * 0.5:
                         _LOGGER.info('Unable to refresh the ambilight layer as often as configured.')
-                        await self._api.update()
+                        await self._client.async_reset()
                         await asyncio.sleep(5)
                     if counter < 2:
                         _LOGGER.info('Unable to refresh the ambilight layer as often as configured..')
-                        await self._api.update()
+                        await self._client.async_reset()
                         await asyncio.sleep(30)
-                elif not self._api.powerstate == 'On':
+                elif not self.powerstate == 'On':
                     _LOGGER.info('The TV seems to be turned OFF but reachable, therefore going to check the ambicolors and then wait 5 seconds before checking again.')
-                    counter = await self.async_follow_ambilight(1, 1)
+                    await self.async_follow_ambilight(1, 1)
                     await asyncio.sleep(4)
                     continue
                 else:
@@ -772,6 +1300,7 @@ class AmbiHue:
         if listener in self._on_update:
             self._on_update.remove(listener)
         self._on_update.append(listener)
+        self._extractor.set_regions(listener._position for listener in self._on_update)
         if len(self._on_update) > 0:
             self.start_following()
             _LOGGER.info('Added listener, there are ' + str(len(self._on_update)) + ' listeners.')
@@ -779,6 +1308,8 @@ class AmbiHue:
     def remove_listener(self, listener):
         if listener in self._on_update:
             self._on_update.remove(listener)
+            self._extractor.set_regions(listener._position for listener in self._on_update)
+            self._dispatcher.discard(getattr(listener, '_lights', []))
             _LOGGER.info('Removed listener, there are ' + str(len(self._on_update)) + ' listeners remaining.')
         if len(self._on_update) == 0:
             _LOGGER.info('The last listener is being removed')
@@ -788,221 +1319,83 @@ class AmbiHue:
         _LOGGER.info('Removed listeners')
         self._on_update.clear()
     
-    async def notify_listeners(self):
-        tasks = []
+    async def async_extract_regions(self):
+        # computes the colour of every distinct ambi_region in use once per frame, shared by all listeners
+        start = time.monotonic()
+        if self._compact:
+            self._colors = self._extractor.extract_frame(self._layer)
+        else:
+            self._colors = self._extractor.extract(self._layer)
+        self.metrics.observe(STAGE_EXTRACT, time.monotonic() - start)
+        self.frame_time = self._fetch_time
+        return self._colors
+
+    async def notify_listeners(self, colors=None):
         try:
-            await asyncio.gather(*(listener.async_update_bulbs() for listener in self._on_update), return_exceptions=True)
+            if colors is None:
+                colors = await self.async_extract_regions()
+            start = time.monotonic()
+            await asyncio.gather(*(listener.async_update_bulbs(*colors.get(listener._position, NO_COLOR)) for listener in self._on_update), return_exceptions=True)
+            self._dispatcher.flush() # fire and forget, the loop never waits on the lights
+            self.metrics.observe(STAGE_FANOUT, time.monotonic() - start)
         except Exception as e:
                 _LOGGER.error('Error occured while notifying the listeners. ' + str(e))
 
+    def rate_limits(self, entity_ids) -> dict:
+        # the throttling state of lights, for the attributes of the switch following them
+        return {entity_id: self._dispatcher.get_limiter(entity_id).as_dict() for entity_id in entity_ids}
+
+    def resolve_lights(self, entity_ids):
+        # lights of a switch with direct_updates are turned on as entities instead of with the service
+        self._dispatcher.resolve(entity_ids)
+
+    def queue_light_update(self, entity_ids, service_data, on_sent=None):
+        # lights with the same service data in a frame, also across listeners, are turned on with one service call
+        self._dispatcher.queue(entity_ids, service_data, self.frame_time, on_sent)
+
     def start_following(self):
         if not self._follow:
             _LOGGER.info('Start following')
             self._follow = True
-            self._future = asyncio.ensure_future(self.async_follow_tv(0.1))
+            if self._replay_file:
+                self._future = asyncio.ensure_future(self.async_follow_replay())
+            else:
+                self._future = asyncio.ensure_future(self.async_follow_tv(1 / self._frame_rate))
 
     def stop_following(self):
         _LOGGER.info('Stop following (because there are no more lights listening)')
         self._follow = False
+        if self._future is not None:
+            self._future.cancel() # otherwise a quick restart could leave two loops polling the tv
+            self._future = None
+        self._dispatcher.cancel()
+        if self._recorder is not None:
+            self._recorder.flush()
+
+    def acquire(self):
+        self._references += 1
+
+    async def async_release(self):
+        # the last entity using this tv is gone, remove it from the registry and close its connection
+        self._references -= 1
+        if self._references > 0:
+            return
+        coordinators = self._hass.data.get(DOMAIN, {}).get('coordinators', {})
+        if coordinators.get(self._ambihueip) is self:
+            del coordinators[self._ambihueip]
+        await self.async_close()
 
-    async def async_get_brightness(self, r, g, b):
-        try:
-            brightness = math.sqrt(
-                r * r * .241 + 
-                g * g * .691 + 
-                b * b * .068
-            )
-            if brightness == 0:
-                brightness = 1
-        except:
-            brightness = 5
-        return brightness
+    async def async_close(self):
+        self.stop_following()
+        if self._recorder is not None:
+            await self._recorder.async_close()
+        await self._client.async_reset()
 
     async def async_get_rgb(self, layer1, position):
-        r,g,b = None, None, None
-
-        if layer1 is None:
-            return r,g,b
-
-        # below calulates different average r,g,b values to send to the lamp
+        # one-off extraction of a single region, the follow loop uses the precompiled self._extractor instead
         # see: http://jointspace.sourceforge.net/projectdata/documentation/jasonApi/1/doc/API-Method-ambilight-measured-GET.html
-        # etc in http://jointspace.sourceforge.net/projectdata/documentation/jasonApi/1/doc/API.html
-        
-        if position == 'top-middle-average': # 'display_options' value given in home assistant 
-            pixels = layer1['top'] # for tv topology see http://jointspace.sourceforge.net/projectdata/documentation/jasonApi/1/doc/API-Method-ambilight-topology-GET.html
-            pixel3 = str((int(len(pixels)/2)-1)) # selects pixels
-            pixel4 = str(int(len(pixels)/2))
-            r = int( ((pixels[pixel3]['r'])**2+(pixels[pixel4]['r'])**2) ** (1/2) ) # function to calulcate desired values
-            g = int( ((pixels[pixel3]['g'])**2+(pixels[pixel4]['g'])**2) ** (1/2) )
-            b = int( ((pixels[pixel3]['b'])**2+(pixels[pixel4]['b'])**2) ** (1/2) )
-            # r,g and b used later in the bulb transition/flow
-        
-        elif position == 'top-average':
-            pixels = layer1['top']
-            r_sum, g_sum, b_sum = 0,0,0
-            for i in range(0,len(pixels)):
-                pixel = str(int(i))
-                r_sum = r_sum + ((pixels[pixel]['r']) ** 2)
-                g_sum = g_sum + ((pixels[pixel]['g']) ** 2)
-                b_sum = b_sum + ((pixels[pixel]['b']) ** 2)
-            r = int((r_sum/len(pixels))**(1/2))
-            g = int((g_sum/len(pixels))**(1/2))
-            b = int((b_sum/len(pixels))**(1/2))
-        elif position == 'right-average':
-            pixels = layer1['right']
-            r_sum, g_sum, b_sum = 0,0,0
-            for i in range(0,len(pixels)):
-                pixel = str(int(i))
-                r_sum = r_sum + ((pixels[pixel]['r']) ** 2)
-                g_sum = g_sum + ((pixels[pixel]['g']) ** 2)
-                b_sum = b_sum + ((pixels[pixel]['b']) ** 2)
-            r = int((r_sum/len(pixels))**(1/2))
-            g = int((g_sum/len(pixels))**(1/2))
-            b = int((b_sum/len(pixels))**(1/2))
-        elif position == 'left-average':
-            pixels = layer1['left']
-            r_sum, g_sum, b_sum = 0,0,0
-            for i in range(0,len(pixels)):
-                pixel = str(int(i))
-                r_sum = r_sum + ((pixels[pixel]['r']) ** 2)
-                g_sum = g_sum + ((pixels[pixel]['g']) ** 2)
-                b_sum = b_sum + ((pixels[pixel]['b']) ** 2)
-            r = int((r_sum/len(pixels))**(1/2))
-            g = int((g_sum/len(pixels))**(1/2))
-            b = int((b_sum/len(pixels))**(1/2))
-        elif position == 'bottom-average':
-            pixels = layer1['bottom']
-            r_sum, g_sum, b_sum = 0,0,0
-            for i in range(0,len(pixels)):
-                pixel = str(int(i))
-                r_sum = r_sum + ((pixels[pixel]['r']) ** 2)
-                g_sum = g_sum + ((pixels[pixel]['g']) ** 2)
-                b_sum = b_sum + ((pixels[pixel]['b']) ** 2)
-            r = int((r_sum/len(pixels))**(1/2))
-            g = int((g_sum/len(pixels))**(1/2))
-            b = int((b_sum/len(pixels))**(1/2))
-        elif position == 'top-middle' or position == 'top-center' or position == 'top':
-            pixels = layer1['top']
-            pixel = str(int(len(pixels)/2))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        elif position == 'bottom-middle' or position == 'bottom-center' or position == 'bottom':
-            pixels = layer1['bottom']
-            pixel = str(int(len(pixels)/2))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        elif position == 'right':
-            pixels = layer1['right']
-            pixel = str(int(len(pixels)/2))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        elif position == 'left':
-            pixels = layer1['left']
-            pixel = str(int(len(pixels)/2))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        elif position == 'top-right-average':
-            r_sum, g_sum, b_sum = 0,0,0
-            rightpixels = layer1['right']
-            rtpixel = rightpixels['0']
-            toppixels = layer1['top']
-            trpixel = toppixels[str(int(len(toppixels)-1))]
-            selected_pixels = [rtpixel,trpixel]
-            for pixel in selected_pixels:
-                r_sum = r_sum + ((pixel['r']) ** 2)
-                g_sum = g_sum + ((pixel['g']) ** 2)
-                b_sum = b_sum + ((pixel['b']) ** 2)
-            r = int((r_sum/len(selected_pixels))*(1/2))
-            g = int((g_sum/len(selected_pixels))*(1/2))
-            b = int((b_sum/len(selected_pixels))*(1/2))
-        elif position == 'top-left-average':
-            r_sum, g_sum, b_sum = 0,0,0
-            leftpixels = layer1['left']
-            ltpixel = leftpixels[str(int(len(leftpixels)-1))]
-            toppixels = layer1['top']
-            tlpixel = toppixels['0']
-            selected_pixels = [ltpixel,tlpixel]
-            for pixel in selected_pixels:
-                r_sum = r_sum + ((pixel['r']) ** 2)
-                g_sum = g_sum + ((pixel['g']) ** 2)
-                b_sum = b_sum + ((pixel['b']) ** 2)
-            r = int((r_sum/len(selected_pixels))*(1/2))
-            g = int((g_sum/len(selected_pixels))*(1/2))
-            b = int((b_sum/len(selected_pixels))*(1/2))
-        elif position == 'bottom-right-average':
-            r_sum, g_sum, b_sum = 0,0,0
-            rightpixels = layer1['right']
-            rbpixel = rightpixels[str(int(len(rightpixels)-1))]
-            bottompixels = layer1['bottom']
-            rbpixel = bottompixels[str(int(len(bottompixels)-1))]
-            selected_pixels = [rbpixel,brpixel]
-            for pixel in selected_pixels:
-                r_sum = r_sum + ((pixel['r']) ** 2)
-                g_sum = g_sum + ((pixel['g']) ** 2)
-                b_sum = b_sum + ((pixel['b']) ** 2)
-            r = int((r_sum/len(selected_pixels))*(1/2))
-            g = int((g_sum/len(selected_pixels))*(1/2))
-            b = int((b_sum/len(selected_pixels))*(1/2))
-        elif position == 'bottom-left-average':
-            r_sum, g_sum, b_sum = 0,0,0
-            leftixels = layer1['left']
-            lbpixel = leftixels['0']
-            bottompixels = layer1['bottom']
-            blpixel = bottompixels['0']
-            selected_pixels = [lbpixel,blpixel]
-            for pixel in selected_pixels:
-                r_sum = r_sum + ((pixel['r']) ** 2)
-                g_sum = g_sum + ((pixel['g']) ** 2)
-                b_sum = b_sum + ((pixel['b']) ** 2)
-            r = int((r_sum/len(selected_pixels))*(1/2))
-            g = int((g_sum/len(selected_pixels))*(1/2))
-            b = int((b_sum/len(selected_pixels))*(1/2))
-        elif position == 'right-top':
-            pixels = layer1['right']
-            r = int(pixels['0']['r'])
-            g = int(pixels['0']['g'])
-            b = int(pixels['0']['b'])
-        elif position == 'left-top':
-            pixels = layer1['left']
-            pixel = str(int(len(pixels)-1))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        elif position == 'top-left':
-            pixels = layer1['top']
-            r = int(pixels['0']['r'])
-            g = int(pixels['0']['g'])
-            b = int(pixels['0']['b'])
-        elif position == 'top-right':
-            pixels = layer1['top']
-            pixel = str(int(len(pixels)-1))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        elif position == 'right-bottom':
-            pixels = layer1['right']
-            pixel = str(int(len(pixels)-1))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        elif position == 'left-bottom':
-            pixels = layer1['left']
-            r = int(pixels['0']['r'])
-            g = int(pixels['0']['g'])
-            b = int(pixels['0']['b'])
-        elif position == 'bottom-left':
-            pixels = layer1['bottom']
-            r = int(pixels['0']['r'])
-            g = int(pixels['0']['g'])
-            b = int(pixels['0']['b'])
-        elif position == 'bottom-right':
-            pixels = layer1['bottom']
-            pixel = str(int(len(pixels)-1))
-            r = int(pixels[pixel]['r'])
-            g = int(pixels[pixel]['g'])
-            b = int(pixels[pixel]['b'])
-        return r, g, b
+        if layer1 is None:
+            return None, None, None
+        extractor = RegionExtractor()
+        extractor.set_regions([position])
+        return extractor.extract(layer1)[position]
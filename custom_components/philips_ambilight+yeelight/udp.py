@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import struct
+import uuid
+
+_LOGGER = logging.getLogger(__name__)
+
+DDP = 'ddp'
+E131 = 'e131'
+PROTOCOLS = (DDP, E131)
+PORTS = {DDP: 4048, E131: 5568}
+
+# DDP (see http://www.3waylabs.com/ddp/): flags, sequence, data type, output id, data offset, data length
+DDP_HEADER = struct.Struct('>BBBBIH')
+DDP_VERSION = 0x40
+DDP_PUSH = 0x01 # set on the last datagram of a frame, the controller shows the frame when it arrives
+DDP_RGB24 = 0x0B
+DDP_OUTPUT = 1 # the controller's default output
+DDP_MAX_DATA = 1440 # bytes per datagram (480 pixels)
+
+# E1.31 / sACN (ANSI E1.31-2018): root layer, framing layer and DMP layer in front of the channel data
+E131_HEADER = struct.Struct('>HH12sHI16sHI64sBHBBHHBBHHHB')
+E131_IDENTIFIER = b'ASC-E1.17\x00\x00\x00'
+E131_PRIORITY = 100
+E131_CHANNELS = 510 # per universe, 170 rgb pixels (of the 512 dmx channels)
+E131_SOURCE = 'philips_ambilight+yeelight'
+E131_CID = uuid.uuid5(uuid.NAMESPACE_DNS, E131_SOURCE).bytes # identifies this sender, the same after a restart
+
+
+def ddp_packets(data, sequence) -> list[bytes]:
+    """Split the pixel data (r, g, b bytes) of a frame into DDP datagrams."""
+    packets = []
+    for offset in range(0, max(len(data), 1), DDP_MAX_DATA):
+        chunk = data[offset:offset + DDP_MAX_DATA]
+        flags = DDP_VERSION | (DDP_PUSH if offset + DDP_MAX_DATA >= len(data) else 0)
+        packets.append(DDP_HEADER.pack(flags, sequence, DDP_RGB24, DDP_OUTPUT, offset, len(chunk)) + chunk)
+    return packets
+
+
+def e131_header(universe, channels) -> bytearray:
+    """Header of an E1.31 data packet, the sequence number (byte 111) is filled in per frame."""
+    length = E131_HEADER.size + channels
+    return bytearray(E131_HEADER.pack(
+        0x0010, 0x0000, E131_IDENTIFIER, 0x7000 | (length - 16), 0x00000004, E131_CID,
+        0x7000 | (length - 38), 0x00000002, E131_SOURCE.encode(), E131_PRIORITY, 0, 0, 0, universe,
+        0x7000 | (length - 115), 0x02, 0xA1, 0x0000, 0x0001, channels + 1, 0x00,
+    ))
+
+
+class UdpOutput:
+    """Streams frames of pixel data to an LED controller over DDP or E1.31, one fire and forget datagram per frame.
+
+    A frame that doesn't fit in one datagram is split, over DDP in blocks of 480 pixels and over E1.31 in
+    universes of 170 pixels (numbered up from universe).
+    """
+
+    def __init__(self, host, protocol=DDP, port=None, universe=1) -> None:
+        self.host = host
+        self.protocol = protocol
+        self._port = port or PORTS[protocol]
+        self._universe = universe
+        self._transport: asyncio.DatagramTransport | None = None
+        self._sequence = 0
+        self._headers: list[bytearray] = [] # e1.31 header of every universe, for frames of _length bytes
+        self._length = None
+        self.datagrams = 0 # per frame, for the last frame
+
+    async def async_open(self):
+        if self._transport is None:
+            loop = asyncio.get_running_loop()
+            self._transport, protocol = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.host, self._port)
+            )
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    def send(self, data) -> None:
+        """Send the pixel data (r, g, b bytes) of one frame."""
+        if self._transport is None:
+            return
+        if self.protocol == DDP:
+            self._sequence = self._sequence % 15 + 1 # 1-15, 0 means not used
+            packets = ddp_packets(data, self._sequence)
+        else:
+            self._sequence = (self._sequence + 1) % 256
+            packets = self._e131_packets(data)
+        for packet in packets:
+            self._transport.sendto(packet)
+        self.datagrams = len(packets)
+
+    def _e131_packets(self, data) -> list[bytes]:
+        if len(data) != self._length:
+            self._length = len(data)
+            self._headers = [
+                e131_header(self._universe + index, len(data[offset:offset + E131_CHANNELS]))
+                for index, offset in enumerate(range(0, len(data), E131_CHANNELS))
+            ]
+        packets = []
+        for header, offset in zip(self._headers, range(0, len(data), E131_CHANNELS)):
+            header[111] = self._sequence
+            packets.append(bytes(header) + data[offset:offset + E131_CHANNELS])
+        return packets
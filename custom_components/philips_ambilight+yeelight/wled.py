@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import json
+import logging
+
+import httpx
+
+from homeassistant.core import HomeAssistant
+from homeassistant.util.ssl import get_default_no_verify_context
+
+_LOGGER = logging.getLogger(__name__)
+
+BASE_URL = 'http://{0}/json/{1}'
+TIMEOUT = 2.0 # seconds, a frame that takes longer is outdated anyway
+
+
+def encode_leds(colors, leds) -> bytes:
+    """Encode the colours of the segments of a strip as one WLED state update.
+
+    The segments are spread evenly over the leds of the strip, see the 'i' (individual leds) property
+    of https://kno.wled.ge/interfaces/json-api/#per-segment-individual-led-control
+    """
+    segments = len(colors)
+    if segments == leds:
+        individual = ['%02X%02X%02X' % color for color in colors]
+    else:
+        individual = []
+        for segment, color in enumerate(colors):
+            individual += [segment * leds // segments, (segment + 1) * leds // segments, '%02X%02X%02X' % color]
+    return json.dumps({'tt': 0, 'seg': {'i': individual}}, separators=(',', ':')).encode()
+
+
+class WledClient:
+    """Long-lived HTTP client for the JSON API of one WLED controller, owned by this class so async_close closes it."""
+
+    def __init__(self, hass: HomeAssistant, host, timeout=TIMEOUT) -> None:
+        self._hass = hass
+        self.host = host
+        self._timeout = timeout
+        self._client: httpx.AsyncClient | None = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                verify=get_default_no_verify_context(), # plain http, but avoids loading the ca certificates in the event loop
+                timeout=httpx.Timeout(self._timeout),
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1), # one frame at a time
+            )
+        return self._client
+
+    async def async_get(self, path) -> dict:
+        response = await self._get_client().get(BASE_URL.format(self.host, path))
+        response.raise_for_status()
+        return response.json()
+
+    async def async_post(self, path, content: bytes) -> None:
+        response = await self._get_client().post(
+            BASE_URL.format(self.host, path), content=content, headers={'Content-Type': 'application/json'}
+        )
+        response.raise_for_status()
+
+    async def async_get_led_count(self) -> int:
+        info = await self.async_get('info')
+        return info['leds']['count']
+
+    async def async_set_state(self, state: dict) -> None:
+        await self.async_post('state', json.dumps(state).encode())
+
+    async def async_set_leds(self, payload: bytes) -> None:
+        """Send a state update made by encode_leds."""
+        await self.async_post('state', payload)
+
+    async def async_close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+
+from yeelight import BulbException
+
+_LOGGER = logging.getLogger(__name__)
+
+YEELIGHT_PORT = 55443
+COMMAND_TIMEOUT = 5.0 # seconds to wait for a connection or a reply from the bulb
+DEFAULT_STATE_TTL = 10 # seconds the cached power/music state of a bulb is trusted without asking it again
+EFFECT, EFFECT_DURATION = "smooth", 300
+DEFAULT_PROPERTIES = ["power", "bright", "rgb", "color_mode", "music_on"]
+MUSIC_WRITE_BUFFER_LIMIT = 16384 # bytes queued for a music mode bulb before frames are dropped
+START_CF_PREFIX, START_CF_SUFFIX = '{"id":1,"method":"start_cf","params":[1,1,"', '"]}\r\n' # encode_command's output around the expression
+
+
+def encode_command(method, params, cmd_id=1) -> bytes:
+    """Serialize a command to a JSON line, once, so the same bytes can be written to many bulbs."""
+    return (json.dumps({'id': cmd_id, 'method': method, 'params': params or []}, separators=(',', ':')) + '\r\n').encode()
+
+
+def encode_color_flow(r, g, b, brightness, duration) -> tuple[list, bytes]:
+    """Return the start_cf params and serialized command of a single RGB transition that stays at its colour.
+
+    Formats the same expression as yeelight's Flow(count=1, action=stay, transitions=[RGBTransition(...)])
+    straight from the numbers, without building the flow objects, the expression and the JSON for every frame.
+    """
+    value = max(0, min(255, int(r))) * 65536 + max(0, min(255, int(g))) * 256 + max(0, min(255, int(b)))
+    expression = '%d, 1, %d, %d' % (max(50, duration), value, min(int(brightness), 100))
+    return [1, 1, expression], (START_CF_PREFIX + expression + START_CF_SUFFIX).encode()
+
+
+class MusicServer:
+    """A single asyncio TCP server accepting the music mode connections of all bulbs.
+
+    In music mode a bulb connects back to the host, and the commands written to that connection
+    are applied without the usual rate limit. One StreamWriter is kept per bulb address.
+    """
+
+    def __init__(self, host='0.0.0.0', port=0) -> None:
+        self._host = host
+        self._port = port
+        self._server: asyncio.AbstractServer | None = None
+        self._writers: dict[str, asyncio.StreamWriter] = {}
+        self._waiting: dict[str, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def async_start(self):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._on_connect, self._host, self._port)
+            _LOGGER.debug('Music mode server listening on port ' + str(self.port))
+
+    def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        ip = writer.get_extra_info('peername')[0]
+        previous = self._writers.get(ip)
+        if previous is not None:
+            previous.close()
+        self._writers[ip] = writer
+        future = self._waiting.pop(ip, None)
+        if future is not None and not future.done():
+            future.set_result(writer)
+        task = asyncio.ensure_future(self._async_watch(ip, reader, writer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _async_watch(self, ip, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # the bulb doesn't send anything in music mode, an EOF means it dropped the connection
+        try:
+            while await reader.read(1024):
+                pass
+        except OSError:
+            pass
+        writer.close()
+        if self._writers.get(ip) is writer:
+            del self._writers[ip]
+            _LOGGER.debug(ip + ' left music mode')
+
+    async def async_wait_for(self, ip, timeout) -> asyncio.StreamWriter:
+        if ip in self._waiting:
+            return await asyncio.wait_for(asyncio.shield(self._waiting[ip]), timeout)
+        future = self._waiting[ip] = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if self._waiting.get(ip) is future:
+                del self._waiting[ip]
+
+    def get_writer(self, ip) -> asyncio.StreamWriter | None:
+        writer = self._writers.get(ip)
+        if writer is None or writer.is_closing():
+            return None
+        return writer
+
+    def release(self, ip):
+        writer = self._writers.pop(ip, None)
+        if writer is not None:
+            writer.close()
+
+    async def async_stop(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+        for task in self._tasks:
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+class AsyncBulb:
+    """Asyncio client for the Yeelight LAN protocol (see: https://www.yeelight.com/download/Yeelight_Inter-Operation_Spec.pdf).
+
+    Mirrors the parts of python-yeelight's Bulb used by this component without blocking the event loop.
+    Commands to one bulb are serialized, commands to different bulbs run concurrently.
+    """
+
+    def __init__(self, ip, music_server: MusicServer, port=YEELIGHT_PORT, timeout=COMMAND_TIMEOUT) -> None:
+        self._ip = ip
+        self._port = port
+        self._timeout = timeout
+        self._music_server = music_server
+        self._lock = asyncio.Lock()
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._read_task: asyncio.Task | None = None
+        self._pending: dict[int, asyncio.Future] = {}
+        self._cmd_id = 0
+        self.last_properties: dict = {}
+        self._properties_time: float | None = None # monotonic time last_properties was known to be current
+
+    @property
+    def ip(self):
+        return self._ip
+
+    @property
+    def music_mode(self) -> bool:
+        return self._music_server.get_writer(self._ip) is not None
+
+    async def _async_connect(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self._ip, self._port), self._timeout
+        )
+        self._read_task = asyncio.ensure_future(self._async_read(self._reader, self._writer))
+
+    async def _async_read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # replies are matched to their command by id, 'props' notifications update last_properties
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    _LOGGER.debug('Ignoring malformed message from ' + self._ip + ': ' + str(line))
+                    continue
+                self._handle_message(message)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            _LOGGER.debug('Lost the connection with ' + self._ip + ': ' + str(e))
+        finally:
+            writer.close()
+            if self._writer is writer:
+                self._disconnected()
+
+    def _handle_message(self, message: dict):
+        if 'id' in message:
+            future = self._pending.pop(message['id'], None)
+            if future is not None and not future.done():
+                future.set_result(message)
+        elif message.get('method') == 'props':
+            # unsolicited state changes, sent while the control connection is open, keep the cache current
+            self.last_properties.update(message.get('params', {}))
+            if self._properties_time is not None:
+                self._properties_time = time.monotonic()
+
+    def _disconnected(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self.invalidate()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(BulbException('Connection with ' + self._ip + ' was closed'))
+        self._pending.clear()
+
+    def _next_id(self) -> int:
+        self._cmd_id += 1
+        return self._cmd_id
+
+    def invalidate(self):
+        """Forget the cached state, the next async_get_properties will ask the bulb."""
+        self._properties_time = None
+
+    async def async_send_command(self, method, params=None) -> dict:
+        try:
+            return await self._async_send_command(method, params)
+        except Exception:
+            self.invalidate()
+            raise
+
+    async def _async_send_command(self, method, params) -> dict:
+        async with self._lock:
+            music_writer = self._music_server.get_writer(self._ip)
+            if music_writer is not None and method not in ('get_prop', 'set_music'):
+                # the music mode channel has no rate limit and never replies
+                music_writer.write(encode_command(method, params, self._next_id()))
+                await music_writer.drain()
+                return {'result': ['ok']}
+            await self._async_connect()
+            cmd_id = self._next_id()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[cmd_id] = future
+            self._writer.write(encode_command(method, params, cmd_id))
+            try:
+                await self._writer.drain()
+                response = await asyncio.wait_for(future, self._timeout)
+            except asyncio.TimeoutError:
+                raise BulbException('No reply from ' + self._ip + ' to ' + method)
+            finally:
+                self._pending.pop(cmd_id, None)
+        if 'error' in response:
+            raise BulbException(response['error'])
+        return response
+
+    async def async_get_properties(self, requested_properties=DEFAULT_PROPERTIES, max_age=0) -> dict:
+        """Return the bulb's properties, from the cache if they were refreshed less than max_age seconds ago."""
+        if (max_age and self._properties_time is not None
+                and time.monotonic() - self._properties_time <= max_age
+                and all(name in self.last_properties for name in requested_properties)):
+            return self.last_properties
+        response = await self.async_send_command('get_prop', requested_properties)
+        properties = [value if value else None for value in response.get('result', [])]
+        self.last_properties.update(zip(requested_properties, properties))
+        self._properties_time = time.monotonic()
+        return self.last_properties
+
+    async def async_turn_on(self):
+        await self.async_send_command('set_power', ['on', EFFECT, EFFECT_DURATION])
+        self.last_properties['power'] = 'on'
+
+    async def async_turn_off(self):
+        await self.async_send_command('set_power', ['off', EFFECT, EFFECT_DURATION])
+        self.last_properties['power'] = 'off'
+
+    async def async_set_brightness(self, brightness):
+        brightness = int(max(1, min(100, brightness)))
+        await self.async_send_command('set_bright', [brightness, EFFECT, EFFECT_DURATION])
+        self.last_properties['bright'] = str(brightness)
+
+    def send_music(self, line: bytes) -> bool:
+        """Write a pre-serialized command line on the music mode channel, dropping it if the bulb can't keep up."""
+        writer = self._music_server.get_writer(self._ip)
+        if writer is None:
+            raise BulbException(self._ip + ' is not in music mode')
+        if writer.transport.get_write_buffer_size() > MUSIC_WRITE_BUFFER_LIMIT:
+            return False
+        writer.write(line)
+        return True
+
+    async def async_start_music(self):
+        if self.music_mode:
+            return
+        await self._music_server.async_start()
+        await self._async_connect()
+        host = self._writer.get_extra_info('sockname')[0] # the address the bulb reaches this host on
+        waiter = asyncio.ensure_future(self._music_server.async_wait_for(self._ip, self._timeout))
+        try:
+            await self.async_send_command('set_music', [1, host, self._music_server.port])
+            await waiter
+            self.last_properties['music_on'] = '1'
+        except asyncio.TimeoutError:
+            raise BulbException(self._ip + ' did not connect for music mode')
+        finally:
+            waiter.cancel()
+
+    async def async_stop_music(self):
+        if not self.music_mode:
+            return
+        self._music_server.release(self._ip)
+        await self.async_send_command('set_music', [0])
+        self.last_properties['music_on'] = '0'
+
+    async def async_close(self):
+        self._music_server.release(self._ip)
+        if self._writer is not None:
+            self._writer.close()
+        if self._read_task is not None:
+            self._read_task.cancel()